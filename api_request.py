@@ -1,25 +1,32 @@
 import json
 import uuid
-import requests
 import time
+import copy
+import hashlib
 import logging
+import threading
 from datetime import datetime, timezone, timedelta
 
+from bulkhead import bulkhead, BulkheadFull, ensure_capacity, no_shedding
 from crypto_helper import (
     encryptsign_xdata, java_like_timestamp, ts_gmt7_without_colon,
-    ax_api_signature, decrypt_xdata, API_KEY, make_x_signature_payment,
-    build_encrypted_field
+    ax_api_signature, decrypt_xdata_raw, API_KEY, make_x_signature_payment,
+    build_encrypted_field, read_response_body, ResponseTooLarge
 )
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
 BASE_URL = "https://api.myxl.xlaxiata.co.id"
 
+# `requests` is imported lazily inside the functions that talk to the network
+# so that importing this module (and therefore `app`) stays fast.
+
 class APIError(Exception):
     """Custom exception for API related errors."""
     pass
 
+class PurchaseOutcomeUnknown(APIError):
+    """The settlement request may have been processed upstream, but its result could not be read."""
+    pass
+
 def validate_contact(contact: str) -> bool:
     """Validates the phone number format."""
     if not contact.startswith("628") or len(contact) > 14:
@@ -28,6 +35,8 @@ def validate_contact(contact: str) -> bool:
 
 def get_otp(contact: str) -> str:
     """Requests an OTP for the given contact number."""
+    import requests
+
     if not validate_contact(contact):
         raise APIError("Invalid phone number format. It must start with '628'.")
 
@@ -50,25 +59,28 @@ def get_otp(contact: str) -> str:
         "User-Agent": "myXL / 8.6.0(1179); com.android.vending; (samsung; SM-N935F; SDK 33; Android 13)"
     }
 
-    logging.info(f"Requesting OTP for contact: {contact}")
+    logging.info("Requesting OTP for contact: %s", contact)
     try:
-        response = requests.get(url, headers=headers, params=querystring, timeout=30)
+        with bulkhead("ciam"):
+            response = requests.get(url, headers=headers, params=querystring, timeout=30)
         response.raise_for_status()
         json_body = response.json()
-        logging.debug(f"OTP Response Body: {json_body}")
+        logging.debug("OTP Response Body: %s", json_body)
 
         if "subscriber_id" not in json_body:
             error_msg = json_body.get("error_description", "Subscriber ID not found in OTP response.")
-            logging.error(f"OTP request failed for {contact}: {error_msg}")
+            logging.error("OTP request failed for %s: %s", contact, error_msg)
             raise APIError(error_msg)
         
         return json_body["subscriber_id"]
     except requests.RequestException as e:
-        logging.error(f"Error requesting OTP for {contact}: {e}")
+        logging.error("Error requesting OTP for %s: %s", contact, e)
         raise APIError(f"Network error during OTP request: {e}")
 
 def submit_otp(contact: str, code: str) -> dict:
     """Submits the OTP code to get tokens."""
+    import requests
+
     if not validate_contact(contact):
         raise APIError("Invalid phone number format.")
     if not code or len(code) != 6 or not code.isdigit():
@@ -97,25 +109,107 @@ def submit_otp(contact: str, code: str) -> dict:
         "User-Agent": "myXL / 8.6.0(1179); com.android.vending; (samsung; SM-N935F; SDK 33; Android 13)",
     }
 
-    logging.info(f"Submitting OTP for contact: {contact}")
+    logging.info("Submitting OTP for contact: %s", contact)
     try:
-        response = requests.post(url, data=payload, headers=headers, timeout=30)
+        with bulkhead("ciam"):
+            response = requests.post(url, data=payload, headers=headers, timeout=30)
         response.raise_for_status()
         json_body = response.json()
 
         if "error" in json_body:
             error_msg = json_body.get('error_description', 'Unknown error during OTP submission.')
-            logging.error(f"OTP submission failed for {contact}: {error_msg}")
+            logging.error("OTP submission failed for %s: %s", contact, error_msg)
             raise APIError(error_msg)
         
-        logging.info(f"Successfully logged in {contact}")
+        logging.info("Successfully logged in %s", contact)
         return json_body
     except requests.RequestException as e:
-        logging.error(f"Error submitting OTP for {contact}: {e}")
+        logging.error("Error submitting OTP for %s: %s", contact, e)
         raise APIError(f"Network error during OTP submission: {e}")
 
-def send_api_request(path: str, payload_dict: dict, id_token: str, method: str = "POST") -> dict:
-    """Sends a signed and encrypted request to the MyXL API."""
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution.
+    The first caller runs the function; callers arriving while it is in flight
+    wait for it and receive their own copy of its result, or an error of the
+    same kind as the one it raised.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlightCall()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                # A fresh exception per follower; re-raising the leader's own
+                # object would rewrite its traceback from several threads.
+                if isinstance(call.error, BulkheadFull):
+                    raise BulkheadFull(call.error.name, call.error.retry_after) from call.error
+                raise APIError(str(call.error)) from call.error
+            # call.result is a private snapshot nobody mutates; each follower gets its own copy
+            return copy.deepcopy(call.result)
+
+        result = None
+        try:
+            result = fn()
+            return result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                logging.debug("Coalesced %s concurrent identical calls into one.", call.waiters)
+                # Snapshot before the leader's caller gets the result and can mutate it
+                if call.error is None:
+                    call.result = copy.deepcopy(result)
+            call.done.set()
+
+_single_flight = SingleFlight()
+
+def _coalesce_key(method: str, path: str, payload_dict: dict, id_token: str | None) -> str:
+    normalized = json.dumps(payload_dict, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha256()
+    for part in (method.upper(), path, normalized, id_token or ""):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def send_api_request(path: str, payload_dict: dict, id_token: str, method: str = "POST",
+                     coalesce: bool = False, user_agnostic: bool = False) -> dict:
+    """
+    Sends a signed and encrypted request to the MyXL API.
+
+    With `coalesce=True` (only for idempotent reads), concurrent identical
+    requests share one upstream call. The key includes the caller's token
+    unless `user_agnostic=True`, in which case any user's in-flight call for
+    the same path and payload can be shared.
+    """
+    if not coalesce:
+        return _send_api_request(path, payload_dict, id_token, method)
+    key = _coalesce_key(method, path, payload_dict, None if user_agnostic else id_token)
+    return _single_flight.do(key, lambda: _send_api_request(path, payload_dict, id_token, method))
+
+def _send_api_request(path: str, payload_dict: dict, id_token: str, method: str = "POST") -> dict:
+    import requests
+
     encrypted_payload = encryptsign_xdata(method=method, path=path, id_token=id_token, payload=payload_dict)
     
     xtime = int(encrypted_payload["encrypted_body"]["xtime"])
@@ -139,17 +233,25 @@ def send_api_request(path: str, payload_dict: dict, id_token: str, method: str =
     }
 
     url = f"{BASE_URL}/{path}"
-    logging.info(f"Sending API request to {url}")
+    logging.info("Sending API request to %s", url)
     try:
-        resp = requests.post(url, headers=headers, data=json.dumps(body), timeout=30)
-        resp.raise_for_status()
-        decrypted_body = decrypt_xdata(resp.json())
+        with bulkhead("myxl"), requests.post(url, headers=headers, data=json.dumps(body), timeout=30, stream=True) as resp:
+            resp.raise_for_status()
+            encrypted_body = read_response_body(resp)
+        # Hand the encrypted bytes to the decrypt service as-is; no parse/re-serialize round trip
+        decrypted_body = decrypt_xdata_raw(encrypted_body)
         return decrypted_body
     except requests.RequestException as e:
-        logging.error(f"API request to {url} failed: {e}")
+        logging.error("API request to %s failed: %s", url, e)
         raise APIError(f"Network error during API request: {e}")
+    except ResponseTooLarge as e:
+        logging.error("API request to %s returned an oversized body: %s", url, e)
+        raise APIError("The API response was too large to process.")
+    except BulkheadFull:
+        # Let the web layer turn saturation into a fast 503
+        raise
     except Exception as e:
-        logging.error(f"Failed to decrypt response from {url}: {e}")
+        logging.error("Failed to decrypt response from %s: %s", url, e)
         raise APIError("Failed to process API response.")
 
 def get_profile(access_token: str, id_token: str) -> dict:
@@ -157,7 +259,7 @@ def get_profile(access_token: str, id_token: str) -> dict:
     path = "api/v8/profile"
     raw_payload = {"access_token": access_token, "app_version": "8.6.0", "is_enterprise": False, "lang": "en"}
     logging.info("Fetching profile...")
-    res = send_api_request(path, raw_payload, id_token, "POST")
+    res = send_api_request(path, raw_payload, id_token, "POST", coalesce=True)
     if res.get("status") != "SUCCESS" or "data" not in res:
         raise APIError(res.get("message", "Failed to fetch profile."))
     return res["data"]
@@ -167,7 +269,7 @@ def get_balance(id_token: str) -> dict:
     path = "api/v8/packages/balance-and-credit"
     raw_payload = {"is_enterprise": False, "lang": "en"}
     logging.info("Fetching balance...")
-    res = send_api_request(path, raw_payload, id_token, "POST")
+    res = send_api_request(path, raw_payload, id_token, "POST", coalesce=True)
     if res.get("status") != "SUCCESS" or "data" not in res or "balance" not in res["data"]:
         raise APIError(res.get("message", "Failed to fetch balance."))
     return res["data"]["balance"]
@@ -181,14 +283,20 @@ def get_family(tokens: dict, family_code: str) -> dict:
         "migration_type": "", "package_family_code": family_code, "is_autobuy": False,
         "is_enterprise": False, "is_pdlp": True, "referral_code": "", "is_migration": False, "lang": "en"
     }
-    logging.info(f"Fetching package family: {family_code}")
-    res = send_api_request(path, payload_dict, id_token, "POST")
+    logging.info("Fetching package family: %s", family_code)
+    # The catalog is the same for every caller, so concurrent syncs share one call
+    res = send_api_request(path, payload_dict, id_token, "POST", coalesce=True, user_agnostic=True)
     if res.get("status") != "SUCCESS" or "data" not in res:
         raise APIError(f"Failed to get package family {family_code}")
     return res["data"]
 
-def get_package(tokens: dict, package_option_code: str) -> dict:
-    """Fetches details for a specific package."""
+def get_package(tokens: dict, package_option_code: str, shared: bool = False) -> dict:
+    """
+    Fetches details for a specific package.
+    Pass `shared=True` when only the display details are needed: the response
+    then may come from another user's concurrent call, so its user-bound
+    fields (e.g. token_confirmation) must not be used.
+    """
     path = "api/v8/xl-stores/options/detail"
     raw_payload = {
         "is_transaction_routine": False, "migration_type": "", "package_family_code": "",
@@ -196,14 +304,17 @@ def get_package(tokens: dict, package_option_code: str) -> dict:
         "is_migration": False, "lang": "en", "package_option_code": package_option_code,
         "is_upsell_pdp": False, "package_variant_code": ""
     }
-    logging.info(f"Fetching package details for: {package_option_code}")
-    res = send_api_request(path, raw_payload, tokens["id_token"], "POST")
+    logging.info("Fetching package details for: %s", package_option_code)
+    # Purchases need their own token_confirmation, so only shared lookups are coalesced
+    res = send_api_request(path, raw_payload, tokens["id_token"], "POST", coalesce=shared, user_agnostic=shared)
     if res.get("status") != "SUCCESS" or "data" not in res:
         raise APIError(res.get("message", "Failed to get package details."))
     return res["data"]
 
 def send_payment_request(payload_dict: dict, access_token: str, id_token: str, token_payment: str, ts_to_sign: int):
     """Sends the final payment settlement request."""
+    import requests
+
     path = "payments/api/v8/settlement-balance"
     package_code = payload_dict["items"][0]["item_code"]
     
@@ -232,21 +343,59 @@ def send_payment_request(payload_dict: dict, access_token: str, id_token: str, t
     }
     
     url = f"{BASE_URL}/{path}"
-    logging.info(f"Sending payment request to {url}")
+    logging.info("Sending payment request to %s", url)
+    # Until the settlement is sent, errors (including load shedding) mean
+    # nothing was charged. After that, the payment may have gone through.
+    sent = False
     try:
-        resp = requests.post(url, headers=headers, data=json.dumps(body), timeout=30)
-        resp.raise_for_status()
-        decrypted_body = decrypt_xdata(resp.json())
-        return decrypted_body
+        with bulkhead("myxl"):
+            sent = True
+            with requests.post(url, headers=headers, data=json.dumps(body), timeout=30, stream=True) as resp:
+                resp.raise_for_status()
+                encrypted_body = read_response_body(resp)
+        # The settlement is done upstream; its result must be read even if xdata is busy
+        with no_shedding():
+            decrypted_body = decrypt_xdata_raw(encrypted_body)
+    except BulkheadFull:
+        if sent:
+            logging.error("Payment request to %s was sent but its response could not be decrypted: xdata busy", url)
+            raise PurchaseOutcomeUnknown("The payment was sent but its result could not be confirmed.")
+        # Let the web layer turn saturation into a fast 503
+        raise
     except requests.RequestException as e:
-        logging.error(f"Payment request to {url} failed: {e}")
-        raise APIError(f"Network error during payment request: {e}")
+        if _settlement_not_processed(e):
+            logging.error("Payment request to %s failed: %s", url, e)
+            raise APIError(f"Network error during payment request: {e}")
+        logging.error("Payment request to %s may have been processed: %s", url, e)
+        raise PurchaseOutcomeUnknown(f"The payment was sent but its result could not be confirmed: {e}")
     except Exception as e:
-        logging.error(f"Failed to decrypt payment response from {url}: {e}")
-        raise APIError("Failed to process payment response.")
+        logging.error("Failed to read payment response from %s: %s", url, e)
+        raise PurchaseOutcomeUnknown("The payment was sent but its result could not be confirmed.")
+
+    if not isinstance(decrypted_body, dict):
+        logging.error("Payment response from %s had no readable result: %r", url, decrypted_body)
+        raise PurchaseOutcomeUnknown("The payment was sent but its result could not be confirmed.")
+    return decrypted_body
+
+def _settlement_not_processed(error) -> bool:
+    """True for failures that prove the provider did not accept the settlement."""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.HTTPError):
+        # A 4xx is an explicit rejection; a 5xx may come from a proxy after the charge
+        return error.response is not None and 400 <= error.response.status_code < 500
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # Refused or unresolvable before any byte of the request was sent
+        return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    return False
 
 def purchase_package(tokens: dict, package_option_code: str) -> dict:
     """Handles the full package purchase flow."""
+    # Shed load before the first step, not part way through the purchase
+    ensure_capacity("xdata", "myxl")
     package_details_data = get_package(tokens, package_option_code)
     
     token_confirmation = package_details_data["token_confirmation"]
@@ -290,7 +439,8 @@ def purchase_package(tokens: dict, package_option_code: str) -> dict:
         settlement_payload, tokens["access_token"], tokens["id_token"], token_payment, ts_to_sign
     )
     
-    logging.info(f"Purchase result: {json.dumps(purchase_result, indent=2)}")
+    logging.info("Purchase result status for %s: %s", payment_target, purchase_result.get("status"))
+    logging.debug("Purchase result: %s", purchase_result)
     
     if purchase_result.get("status") != "SUCCESS":
         raise APIError(purchase_result.get("message", "Package purchase failed."))
@@ -1,18 +1,101 @@
 import os
+import uuid
+import threading
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import io
+import csv
+import json
+import hashlib
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, abort, Response, stream_with_context, send_from_directory
 
 # Import the refactored API functions and custom exception
-from api_request import get_otp, submit_otp, APIError, get_package, purchase_package
+from api_request import get_otp, submit_otp, APIError, PurchaseOutcomeUnknown, get_package, purchase_package
 from util import get_user_data
 from paket_xut import get_package_xut
-from database import init_db, get_db_connection, get_all_packages
+from markupsafe import Markup
+from database import (
+    init_db, get_db_connection, get_all_packages, get_catalog_version, save_user_tokens,
+    reserve_balance, refund_balance,
+)
+from bulk_purchase import parse_bulk_items, start_bulk_purchase, get_job, list_jobs
+from events import publish, stream_events
+import audit
+from bulkhead import BulkheadFull, occupancy
+from crypto_helper import xdata_pool
+import profiling
+from assets import init_assets, asset_url
+from fragment_cache import FragmentCache
+from log_config import setup_logging, request_id_var
 import logging
 
 app = Flask(__name__)
 # A secret key is required for session management
 app.secret_key = os.urandom(24)
 app.config['ADMIN_PHONE_NUMBERS'] = ['6281818988646'] # As requested by user
+app.config['BULK_PURCHASE_MAX_WORKERS'] = 8
+app.config['BULK_PURCHASE_MAX_IN_FLIGHT_PER_HOST'] = 4
+
+# Static files are fingerprinted and precompressed on first use
+init_assets(app)
+
+# Rendered package-list HTML, keyed by catalog version
+package_list_cache = FragmentCache()
+
+_initialized = False
+_init_lock = threading.Lock()
+
+def initialize_app():
+    """
+    Runs one-time setup (logging, database schema checks) outside the import path.
+    Called before the first request, and eagerly when run as a script.
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if not _initialized:
+            setup_logging()
+            init_db()
+            _initialized = True
+
+@app.before_request
+def bind_request_id():
+    # Reuse an upstream proxy's request id when present so log lines can be correlated
+    g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    g.request_id_token = request_id_var.set(g.request_id)
+
+@app.before_request
+def ensure_initialized():
+    initialize_app()
+
+# On-demand profiling hooks; idle cost is one control-file stat per second
+profiling.init_profiling(app)
+
+@app.after_request
+def expose_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-Id'] = g.request_id
+    return response
+
+@app.teardown_request
+def unbind_request_id(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        request_id_var.reset(token)
+
+@app.errorhandler(BulkheadFull)
+def upstream_busy(e):
+    # Fail fast instead of tying up a worker while an upstream is saturated
+    logging.warning("Shedding %s %s: %s bulkhead full", request.method, request.path, e.name)
+    response = app.make_response((render_template('busy.html', message=str(e), retry_after=e.retry_after), 503))
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.route('/health')
+def health():
+    """Local-only liveness check with per-dependency bulkhead occupancy and xdata endpoint stats."""
+    return jsonify(status="ok", xdata_endpoints=xdata_pool.snapshot(), **occupancy())
 
 # Decorator to protect routes that require login
 def login_required(f):
@@ -100,6 +183,9 @@ def otp():
 
             conn.close()
 
+            # Keep the latest tokens so admins can run bulk purchases for this number
+            save_user_tokens(phone_number, tokens)
+
             # Store a combined user data object in the session
             session['user_data'] = {
                 'phone_number': db_user['phone_number'],
@@ -127,9 +213,55 @@ def logout():
 def dashboard():
     # User data is fetched from the session
     user_data = session.get('user_data')
-    # Packages are now fetched from our local database
-    packages = get_all_packages()
-    return render_template('dashboard.html', user_data=user_data, packages=packages)
+    catalog_version = get_catalog_version()
+
+    # Everything the page depends on; unchanged dashboards are answered with a 304.
+    # Pending flash messages make the page one-off, so those are always rendered.
+    cacheable = '_flashes' not in session
+    etag = hashlib.sha256(json.dumps([
+        catalog_version, user_data, asset_url('style.css'),
+    ], sort_keys=True, default=str).encode('utf-8')).hexdigest()[:32]
+    if cacheable and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        # The package list is shared by every user, so it is rendered once per
+        # catalog version and only the per-user parts are rendered each time
+        package_list_html = package_list_cache.get_or_render(
+            catalog_version,
+            lambda: Markup(render_template('_package_list.html', packages=get_all_packages())),
+        )
+        response = app.make_response(render_template(
+            'dashboard.html', user_data=user_data, package_list_html=package_list_html
+        ))
+
+    if cacheable:
+        response.set_etag(etag)
+    # Always revalidate; the page is per-user and must never be served stale
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/events')
+@login_required
+def events_stream():
+    """Server-Sent Events feed of balance changes and purchase results for the logged-in user."""
+    phone_number = session['user_data']['phone_number']
+
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+
+    # Always start with the authoritative balance; the one in the session may be stale
+    conn = get_db_connection()
+    user = conn.execute('SELECT balance FROM users WHERE phone_number = ?', (phone_number,)).fetchone()
+    conn.close()
+    initial_events = []
+    if user is not None:
+        initial_events.append({"type": "balance", "data": json.dumps({"balance": user['balance']})})
+
+    return Response(
+        stream_with_context(stream_events(phone_number, last_event_id, initial_events)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 @app.route('/purchase/<package_code>')
 @login_required
@@ -148,7 +280,7 @@ def purchase_package_page(package_code):
 
         # For details, we still need to hit the API, as we don't store T&C
         try:
-            package_details_raw = get_package(session['tokens'], package_code)
+            package_details_raw = get_package(session['tokens'], package_code, shared=True)
             detail_html = package_details_raw["package_option"]["tnc"]
             detail = detail_html.replace("<p>", "").replace("</p>", "<br>")
         except APIError as e:
@@ -164,6 +296,8 @@ def purchase_package_page(package_code):
 
         return render_template('purchase.html', package=package_details)
 
+    except BulkheadFull:
+        raise
     except Exception as e:
         flash(f"An unexpected error occurred while fetching package details: {e}", "danger")
         return redirect(url_for('dashboard'))
@@ -175,54 +309,99 @@ def confirm_purchase(package_code):
 
     # Get package details from our DB
     package_data = conn.execute('SELECT * FROM packages WHERE code = ?', (package_code,)).fetchone()
+    conn.close()
     if not package_data:
         flash("Package not found.", "danger")
-        conn.close()
         return redirect(url_for('dashboard'))
 
-    # Get user details from our DB
     user_phone = session['user_data']['phone_number']
-    user = conn.execute('SELECT * FROM users WHERE phone_number = ?', (user_phone,)).fetchone()
 
     # Determine the price
     price = package_data['admin_price'] if package_data['admin_price'] is not None else package_data['price']
 
-    # Check for sufficient balance
-    if user['balance'] < price:
-        flash(f"Insufficient balance. You need Rp {price:,.0f} but only have Rp {user['balance']:,.0f}.", "danger")
+    # 1. Reserve the price and commit straight away, as bulk purchases do, so no
+    # SQLite write lock is held while waiting on the provider
+    try:
+        new_balance = reserve_balance(user_phone, price)
+    except Exception as e:
+        flash(f"An unexpected error occurred during purchase: {e}. Your balance has not been charged.", "danger")
+        return redirect(url_for('dashboard'))
+
+    if new_balance is None:
+        conn = get_db_connection()
+        user = conn.execute('SELECT balance FROM users WHERE phone_number = ?', (user_phone,)).fetchone()
         conn.close()
+        flash(f"Insufficient balance. You need Rp {price:,.0f} but only have Rp {user['balance']:,.0f}.", "danger")
         return redirect(url_for('dashboard'))
 
-    # If balance is sufficient, deduct and proceed
-    new_balance = user['balance'] - price
-    try:
-        # 1. Deduct balance from our database
-        conn.execute('UPDATE users SET balance = ? WHERE phone_number = ?', (new_balance, user_phone))
+    audit.record('balance', phone_number=user_phone, package_code=package_code,
+                 old_value=new_balance + price, new_value=new_balance, actor=user_phone,
+                 detail={'source': 'purchase'})
 
+    try:
         # 2. Attempt to purchase from provider
         result = purchase_package(session['tokens'], package_code)
 
-        # 3. If both are successful, commit the transaction
-        conn.commit()
-
-        # 4. Update session and flash success
+        # 3. Update session and flash success
         session['user_data']['balance'] = new_balance
         session.modified = True # Mark session as modified
-        flash(f"Successfully purchased {package_data['name']}! Transaction ID: {result.get('data', {}).get('transaction_id', 'N/A')}", "success")
-
-    except APIError as e:
-        # If API purchase fails, roll back the DB change
-        conn.rollback()
-        flash(f"Purchase failed at provider level: {e}. Your balance has not been charged.", "danger")
+        transaction_id = result.get('data', {}).get('transaction_id', 'N/A')
+        flash(f"Successfully purchased {package_data['name']}! Transaction ID: {transaction_id}", "success")
+
+        # 4. Push the outcome to the user's other open dashboards
+        publish(user_phone, "balance", {"balance": new_balance})
+        publish(user_phone, "purchase", {
+            "status": "success", "package": package_data['name'], "transaction_id": transaction_id,
+        })
+
+    except BulkheadFull:
+        # Shedding only happens before the settlement is sent, so nothing was
+        # charged upstream; give the reservation back and shed the request
+        _refund_purchase(user_phone, package_code, price, "load shed")
+        raise
+    except PurchaseOutcomeUnknown as e:
+        # The provider may have delivered the package, so the deduction stands
+        # until an admin has checked the transaction and refunded it if needed
+        logging.error("Purchase of %s for %s has an unknown outcome: %s", package_code, user_phone, e)
+        audit.record('balance', phone_number=user_phone, package_code=package_code,
+                     old_value=new_balance, new_value=new_balance, actor=user_phone,
+                     detail={'source': 'purchase', 'outcome': 'unknown', 'error': str(e)})
+        session['user_data']['balance'] = new_balance
+        session.modified = True
+        flash(f"We could not confirm the purchase of {package_data['name']}: {e} "
+              f"Rp {price:,.0f} has been held from your balance until an admin verifies it.", "warning")
+        publish(user_phone, "balance", {"balance": new_balance})
+        publish(user_phone, "purchase", {"status": "unknown", "package": package_data['name'], "message": str(e)})
     except Exception as e:
-        # If any other error occurs, roll back
-        conn.rollback()
-        flash(f"An unexpected error occurred during purchase: {e}. Your balance has not been charged.", "danger")
-    finally:
-        conn.close()
+        # The provider rejected the purchase (or it failed before the settlement); refund the reservation
+        refunded = _refund_purchase(user_phone, package_code, price, str(e))
+        if isinstance(e, APIError):
+            message = f"Purchase failed at provider level: {e}."
+        else:
+            message = f"An unexpected error occurred during purchase: {e}."
+        if refunded:
+            flash(f"{message} Your balance has not been charged.", "danger")
+        else:
+            flash(f"{message} Rp {price:,.0f} could not be refunded automatically; please contact an admin.", "danger")
+        publish(user_phone, "purchase", {"status": "failed", "package": package_data['name'], "message": str(e)})
 
     return redirect(url_for('dashboard'))
 
+def _refund_purchase(user_phone: str, package_code: str, price: int, reason: str) -> bool:
+    """Gives back a purchase reservation and records it. Returns False if the refund itself failed."""
+    try:
+        refunded_balance = refund_balance(user_phone, price)
+    except Exception as e:
+        logging.error("Refund of %s for %s (%s) failed; manual refund needed: %s", price, user_phone, package_code, e)
+        return False
+    audit.record('balance', phone_number=user_phone, package_code=package_code,
+                 old_value=refunded_balance - price, new_value=refunded_balance, actor=user_phone,
+                 detail={'source': 'purchase_refund', 'reason': reason})
+    session['user_data']['balance'] = refunded_balance
+    session.modified = True
+    publish(user_phone, "balance", {"balance": refunded_balance})
+    return True
+
 
 def sync_packages_from_api(tokens: dict):
     """
@@ -234,11 +413,17 @@ def sync_packages_from_api(tokens: dict):
         api_packages = get_package_xut(tokens)
         conn = get_db_connection()
         cursor = conn.cursor()
+        # Hold the write lock from the first read so the recorded old prices are exact
+        cursor.execute('BEGIN IMMEDIATE')
 
+        price_changes = []
         for pkg in api_packages:
             cursor.execute("SELECT * FROM packages WHERE code = ?", (pkg['code'],))
             existing_pkg = cursor.fetchone()
 
+            if existing_pkg is None or existing_pkg['price'] != pkg['price']:
+                price_changes.append((pkg['code'], existing_pkg['price'] if existing_pkg else None, pkg['price']))
+
             if existing_pkg:
                 # Update name and original price, but keep admin_price
                 cursor.execute("""
@@ -255,13 +440,15 @@ def sync_packages_from_api(tokens: dict):
 
         conn.commit()
         conn.close()
-        logging.info(f"Package sync complete. Processed {len(api_packages)} packages.")
+        for code, old_price, new_price in price_changes:
+            audit.record('price', package_code=code, old_value=old_price, new_value=new_price, actor='provider-sync')
+        logging.info("Package sync complete. Processed %s packages.", len(api_packages))
         return len(api_packages)
     except APIError as e:
-        logging.error(f"API Error during package sync: {e}")
+        logging.error("API Error during package sync: %s", e)
         raise
     except Exception as e:
-        logging.error(f"An unexpected error occurred during package sync: {e}")
+        logging.error("An unexpected error occurred during package sync: %s", e)
         raise
 
 # ADMIN ROUTES #
@@ -301,9 +488,16 @@ def admin_update_balance():
     try:
         balance_val = int(balance)
         conn = get_db_connection()
+        # Read and write in one write transaction so the audited old value can't go stale
+        conn.execute('BEGIN IMMEDIATE')
+        old_user = conn.execute('SELECT balance FROM users WHERE phone_number = ?', (phone_number,)).fetchone()
         conn.execute('UPDATE users SET balance = ? WHERE phone_number = ?', (balance_val, phone_number))
         conn.commit()
         conn.close()
+        if old_user is not None:
+            audit.record('balance', phone_number=phone_number, old_value=old_user['balance'], new_value=balance_val,
+                         actor=session['user_data']['phone_number'], detail={'source': 'admin'})
+        publish(phone_number, "balance", {"balance": balance_val})
         flash(f"Successfully updated balance for {phone_number}.", "success")
     except ValueError:
         flash("Invalid balance amount. Please enter a number.", "danger")
@@ -330,9 +524,14 @@ def admin_update_price():
             return redirect(url_for('admin_panel'))
 
         conn = get_db_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        old_pkg = conn.execute('SELECT admin_price FROM packages WHERE code = ?', (package_code,)).fetchone()
         conn.execute('UPDATE packages SET admin_price = ? WHERE code = ?', (price_val, package_code))
         conn.commit()
         conn.close()
+        if old_pkg is not None:
+            audit.record('admin_price', package_code=package_code, old_value=old_pkg['admin_price'], new_value=price_val,
+                         actor=session['user_data']['phone_number'])
         flash(f"Successfully updated price for package {package_code}.", "success")
     except ValueError:
         flash("Invalid price amount. Please enter a number.", "danger")
@@ -341,10 +540,135 @@ def admin_update_price():
 
     return redirect(url_for('admin_panel'))
 
+@app.route('/admin/bulk_purchase', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_bulk_purchase():
+    if request.method == 'POST':
+        raw_items = request.form.get('items', '')
+        try:
+            items = parse_bulk_items(raw_items)
+        except ValueError as e:
+            flash(str(e), "danger")
+            return render_template('bulk_purchase.html', jobs=list_jobs(), raw_items=raw_items)
+
+        job = start_bulk_purchase(
+            items,
+            submitted_by=session['user_data']['phone_number'],
+            max_workers=app.config['BULK_PURCHASE_MAX_WORKERS'],
+            max_in_flight_per_host=app.config['BULK_PURCHASE_MAX_IN_FLIGHT_PER_HOST'],
+        )
+        flash(f"Bulk purchase started with {len(items)} items.", "success")
+        return redirect(url_for('admin_bulk_purchase_job', job_id=job.id))
+
+    return render_template('bulk_purchase.html', jobs=list_jobs(), raw_items='')
+
+@app.route('/admin/bulk_purchase/<job_id>')
+@login_required
+@admin_required
+def admin_bulk_purchase_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        flash("Bulk purchase job not found. It may have run on another worker or expired.", "warning")
+        return redirect(url_for('admin_bulk_purchase'))
+    return render_template('bulk_purchase_job.html', job=job.to_dict())
+
+@app.route('/admin/bulk_purchase/<job_id>/status')
+@login_required
+@admin_required
+def admin_bulk_purchase_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+@app.route('/admin/bulk_purchase/<job_id>/report.csv')
+@login_required
+@admin_required
+def admin_bulk_purchase_report(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['#', 'phone_number', 'package_code', 'status', 'price', 'transaction_id', 'duration_s', 'message'])
+    for item in job.to_dict()['items']:
+        writer.writerow([
+            item['index'], item['phone_number'], item['package_code'], item['status'], item['price'],
+            item['transaction_id'] or '', f"{item['duration']:.2f}" if item['duration'] is not None else '',
+            item['message'],
+        ])
+    return Response(
+        output.getvalue(), mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=bulk_purchase_{job.id}.csv'}
+    )
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_profiling():
+    endpoints = sorted(rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != 'static')
+
+    if request.method == 'POST':
+        if request.form.get('action') == 'disarm':
+            profiling.disarm()
+            flash("Profiling disarmed.", "info")
+            return redirect(url_for('admin_profiling'))
+
+        selected = [e for e in request.form.getlist('endpoints') if e in endpoints]
+        try:
+            control = profiling.arm(
+                mode=request.form.get('mode', ''),
+                endpoints=selected,
+                requests_count=int(request.form.get('requests') or 0),
+                seconds=float(request.form.get('seconds') or 0),
+            )
+            flash(f"Profiling armed on all workers ({control['mode']}, id {control['id']}).", "success")
+        except ValueError as e:
+            flash(str(e), "danger")
+        return redirect(url_for('admin_profiling'))
+
+    return render_template(
+        'profiling.html', endpoints=endpoints, control=profiling.current_control(), outputs=profiling.list_outputs()
+    )
+
+@app.route('/admin/profiling/files/<path:filename>')
+@login_required
+@admin_required
+def admin_profiling_file(filename):
+    return send_from_directory(os.path.abspath(profiling.PROFILE_DIR), filename, as_attachment=True)
+
+@app.route('/admin/audit')
+@login_required
+@admin_required
+def admin_audit():
+    phone_number = request.args.get('phone_number', '').strip()
+    kind = request.args.get('kind', '').strip()
+    date_from = request.args.get('from', '').strip()
+    date_to = request.args.get('to', '').strip()
+
+    try:
+        start = datetime.strptime(date_from, '%Y-%m-%d').timestamp() if date_from else None
+        # The end date is inclusive, so the range runs to the start of the following day
+        end = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).timestamp() if date_to else None
+    except ValueError:
+        flash("Invalid date. Use the YYYY-MM-DD format.", "danger")
+        start = end = None
+
+    entries = [
+        dict(row, time=datetime.fromtimestamp(row['ts']).strftime('%Y-%m-%d %H:%M:%S'))
+        for row in audit.query_audit(phone_number=phone_number or None, start=start, end=end, kind=kind or None)
+    ]
+    return render_template(
+        'audit.html', entries=entries,
+        filters={'phone_number': phone_number, 'kind': kind, 'from': date_from, 'to': date_to},
+    )
+
 
 if __name__ == '__main__':
     # Initialize the database
-    init_db()
+    initialize_app()
     # Use 0.0.0.0 to make it accessible from the host machine
     # debug=False is important for production, but True is fine for development
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
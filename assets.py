@@ -0,0 +1,168 @@
+import os
+import gzip
+import hashlib
+import logging
+import mimetypes
+import threading
+from flask import request, abort, Response, current_app
+
+# Fingerprinted and precompressed copies of everything under static/ are
+# written here at startup. A reverse proxy can serve this directory directly
+# (e.g. nginx `gzip_static`/`brotli_static`); the Flask route below is only a
+# fallback for when the app is exposed without one.
+DIST_DIRNAME = "dist"
+ASSET_URL_PREFIX = "/assets"
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+HASH_LENGTH = 12
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".html", ".txt", ".json", ".map"}
+ETAG_SUFFIXES = {None: "", "br": "-br", "gzip": "-gz"}
+
+# Maps logical filename (e.g. "style.css") -> fingerprinted name ("style.3f9a...css")
+_manifest = {}
+# Maps fingerprinted name -> {"identity": bytes, "br": bytes, "gzip": bytes, "mimetype": str}
+_variants = {}
+_built = False
+_build_lock = threading.Lock()
+
+def _fingerprinted_name(rel_path: str, digest: str) -> str:
+    root, ext = os.path.splitext(rel_path)
+    return f"{root}.{digest[:HASH_LENGTH]}{ext}"
+
+def _write_if_missing(path: str, data: bytes):
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _read(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _build_asset(static_dir: str, dist_dir: str, rel_path: str):
+    """Fingerprints a single static file and makes sure its compressed variants exist."""
+    with open(os.path.join(static_dir, rel_path), "rb") as f:
+        content = f.read()
+
+    name = _fingerprinted_name(rel_path, hashlib.sha256(content).hexdigest())
+    out_path = os.path.join(dist_dir, name)
+    _write_if_missing(out_path, content)
+
+    variants = {
+        "identity": content,
+        "mimetype": mimetypes.guess_type(rel_path)[0] or "application/octet-stream",
+    }
+    if os.path.splitext(rel_path)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+        # Content-addressed names mean an existing file is always up to date,
+        # so the expensive compression only runs once per content change.
+        br_data = _read(f"{out_path}.br")
+        if br_data is None:
+            import brotli
+            br_data = brotli.compress(content, quality=11)
+            _write_if_missing(f"{out_path}.br", br_data)
+
+        gz_data = _read(f"{out_path}.gz")
+        if gz_data is None:
+            gz_data = gzip.compress(content, compresslevel=9, mtime=0)
+            _write_if_missing(f"{out_path}.gz", gz_data)
+
+        # Only keep variants that actually save bytes.
+        if len(br_data) < len(content):
+            variants["br"] = br_data
+        if len(gz_data) < len(content):
+            variants["gzip"] = gz_data
+
+    _manifest[rel_path] = name
+    _variants[name] = variants
+
+def build_assets(static_dir: str):
+    """Fingerprints and precompresses all files in the static directory."""
+    dist_dir = os.path.join(static_dir, DIST_DIRNAME)
+    _manifest.clear()
+    _variants.clear()
+
+    for root, dirs, files in os.walk(static_dir):
+        # Never fingerprint our own output.
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist_dir]
+        for filename in files:
+            rel_path = os.path.relpath(os.path.join(root, filename), static_dir).replace(os.sep, "/")
+            try:
+                _build_asset(static_dir, dist_dir, rel_path)
+            except OSError as e:
+                logging.error("Failed to build static asset %s: %s", rel_path, e)
+
+    logging.info("Built %s fingerprinted static assets.", len(_manifest))
+
+def _ensure_built():
+    """Builds the manifest on first use instead of at import time."""
+    global _built
+    if _built:
+        return
+    with _build_lock:
+        if not _built:
+            build_assets(current_app.static_folder)
+            _built = True
+
+def asset_url(filename: str) -> str:
+    """Returns the fingerprinted URL for a static file, falling back to the plain static URL."""
+    _ensure_built()
+    name = _manifest.get(filename)
+    if name is None:
+        from flask import url_for
+        return url_for("static", filename=filename)
+    return f"{request.script_root}{ASSET_URL_PREFIX}/{name}"
+
+def _accepted_encodings() -> set:
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        token, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if token:
+            accepted.add(token.lower())
+    return accepted
+
+def serve_asset(name: str):
+    """Serves a fingerprinted asset, picking the best precompressed variant."""
+    _ensure_built()
+    variants = _variants.get(name)
+    if variants is None:
+        abort(404)
+
+    accepted = _accepted_encodings()
+    encoding = None
+    for candidate in ("br", "gzip"):
+        if candidate in variants and candidate in accepted:
+            encoding = candidate
+            break
+    # Each encoding is a different body, so each gets its own ETag
+    etag = f"{name}{ETAG_SUFFIXES[encoding]}"
+
+    # The URL changes whenever the content does, so a matching ETag for the
+    # same URL is by definition still fresh.
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = variants[encoding] if encoding else variants["identity"]
+        response = Response(body, mimetype=variants["mimetype"])
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    response.set_etag(etag)
+    if "br" in variants or "gzip" in variants:
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def init_assets(app):
+    """
+    Registers the fingerprinted asset route on the app.
+    The manifest itself is built lazily on the first request that needs it.
+    """
+    app.add_url_rule(f"{ASSET_URL_PREFIX}/<path:name>", "assets", serve_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
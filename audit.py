@@ -0,0 +1,157 @@
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from database import get_db_connection, is_locked_error
+from log_config import request_id_var
+
+# A batch is committed once it has this many events...
+MAX_BATCH_SIZE = 500
+# ...or once its oldest event has waited this long, whichever comes first
+MAX_BATCH_DELAY = 0.2
+QUEUE_SIZE = 50000
+# How long a request thread may block if the queue is full before the event is dropped
+ENQUEUE_TIMEOUT = 1.0
+# The writer waits this long on a locked database per attempt, then backs off and retries
+WRITE_TIMEOUT = 30.0
+RETRY_DELAY = 0.25
+MAX_RETRY_DELAY = 5.0
+# Long enough for shutdown to outlast a writer waiting out a lock
+STOP_TIMEOUT = 2 * WRITE_TIMEOUT
+
+_STOP = object()
+
+class AuditWriter(threading.Thread):
+    """
+    Background writer that group-commits audit events, so many changes share
+    one transaction (and one fsync) instead of paying for one each.
+    """
+    def __init__(self):
+        super().__init__(name="audit-writer", daemon=True)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def submit(self, event: tuple):
+        try:
+            self.queue.put(event, timeout=ENQUEUE_TIMEOUT)
+        except queue.Full:
+            logging.error("Audit queue full; dropping event: %s", event)
+
+    def run(self):
+        conn = get_db_connection(timeout=WRITE_TIMEOUT)
+        stopping = False
+        while not stopping:
+            event = self.queue.get()
+            if event is _STOP:
+                break
+            batch = [event]
+            deadline = time.monotonic() + MAX_BATCH_DELAY
+            while len(batch) < MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is _STOP:
+                    stopping = True
+                    break
+                batch.append(event)
+            self._write(conn, batch)
+
+        # Drain anything enqueued before shutdown
+        leftovers = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is not _STOP:
+                leftovers.append(event)
+        if leftovers:
+            self._write(conn, leftovers)
+        conn.close()
+
+    def _write(self, conn, batch: list):
+        """Commits a batch, holding on to it for as long as the database stays locked."""
+        attempt = 0
+        while True:
+            try:
+                with conn:
+                    conn.executemany("""
+                        INSERT INTO audit_log
+                            (ts, kind, phone_number, package_code, old_value, new_value, delta, actor, request_id, detail)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, batch)
+                return
+            except Exception as e:
+                if not is_locked_error(e):
+                    logging.error("Failed to write %s audit events: %s", len(batch), e)
+                    return
+                logging.warning("Audit database locked; retrying %s events.", len(batch))
+                time.sleep(min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt))
+                attempt += 1
+
+    def stop(self, timeout: float = STOP_TIMEOUT):
+        self.queue.put(_STOP)
+        self.join(timeout)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def _get_writer() -> AuditWriter:
+    global _writer
+    if _writer is not None:
+        return _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = AuditWriter()
+            _writer.start()
+            atexit.register(shutdown)
+        return _writer
+
+def record(kind: str, phone_number: str | None = None, package_code: str | None = None,
+           old_value: int | None = None, new_value: int | None = None, delta: int | None = None,
+           actor: str | None = None, detail: dict | None = None):
+    """Queues an audit event. Returns immediately; the write happens in a group commit."""
+    if delta is None and old_value is not None and new_value is not None:
+        delta = new_value - old_value
+    _get_writer().submit((
+        time.time(), kind, phone_number, package_code, old_value, new_value, delta,
+        actor, request_id_var.get(), json.dumps(detail) if detail else None,
+    ))
+
+def shutdown():
+    """Flushes pending audit events and stops the writer."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+def query_audit(phone_number: str | None = None, start: float | None = None, end: float | None = None,
+                kind: str | None = None, limit: int = 500) -> list:
+    """Returns audit events newest first, filtered by phone number, time range and kind."""
+    clauses, params = [], []
+    if phone_number:
+        clauses.append("phone_number = ?")
+        params.append(phone_number)
+    if start is not None:
+        clauses.append("ts >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("ts < ?")
+        params.append(end)
+    if kind:
+        clauses.append("kind = ?")
+        params.append(kind)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    params.append(limit)
+
+    conn = get_db_connection()
+    rows = conn.execute(f"SELECT * FROM audit_log {where} ORDER BY ts DESC, id DESC LIMIT ?", params).fetchall()
+    conn.close()
+    return rows
@@ -0,0 +1,111 @@
+"""
+Measures worker startup cost: `python -X importtime -c "import app"` and the
+time from a fresh interpreter to the first served response.
+Prints a JSON report that can be compared between CI runs.
+
+Usage: python benchmark_startup.py [--runs N] [--top N] [--output FILE]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that should not be loaded just by importing the app.
+HEAVY_MODULES = ["requests", "brotli", "Crypto.Cipher.AES"]
+
+FIRST_RESPONSE_SNIPPET = """
+import os, time, json, sys, shutil, tempfile
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+# The first request runs init_db(); keep it away from the real regar_store.db
+import database
+tmp_dir = tempfile.mkdtemp()
+database.DATABASE_URL = os.path.join(tmp_dir, "benchmark.db")
+heavy_loaded = [m for m in %r if m in sys.modules]
+client = app.app.test_client()
+resp = client.get('/login')
+t2 = time.perf_counter()
+print(json.dumps({
+    "import_s": t1 - t0,
+    "first_response_s": t2 - t0,
+    "status": resp.status_code,
+    "heavy_loaded": heavy_loaded,
+}))
+shutil.rmtree(tmp_dir, ignore_errors=True)
+"""
+
+def run_importtime(top: int) -> dict:
+    """Runs `-X importtime` once and returns the total and the slowest modules."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+
+    app_entry = next((e for e in entries if e["module"] == "app"), None)
+    return {
+        "app_cumulative_us": app_entry["cumulative_us"] if app_entry else None,
+        "modules_imported": len(entries),
+        "slowest_cumulative": sorted(entries, key=lambda e: e["cumulative_us"], reverse=True)[:top],
+    }
+
+def run_first_response() -> dict:
+    """Starts a fresh interpreter, imports the app and serves one request."""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", FIRST_RESPONSE_SNIPPET % (HEAVY_MODULES,)],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - start
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process_wall_s"] = wall
+    return result
+
+def summarize(values: list) -> dict:
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "max": max(values),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh-interpreter runs.")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to report.")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+    args = parser.parse_args()
+
+    importtime = run_importtime(args.top)
+    runs = [run_first_response() for _ in range(args.runs)]
+
+    report = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "importtime": importtime,
+        "import_s": summarize([r["import_s"] for r in runs]),
+        "first_response_s": summarize([r["first_response_s"] for r in runs]),
+        "process_wall_s": summarize([r["process_wall_s"] for r in runs]),
+        "first_response_status": runs[-1]["status"],
+        "heavy_modules_loaded_at_import": runs[-1]["heavy_loaded"],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import json
+import time
+import uuid
+import base64
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from api_request import purchase_package, APIError, PurchaseOutcomeUnknown, BASE_URL
+from database import get_db_connection, get_user_tokens, reserve_balance, refund_balance
+from events import publish, publish_balance
+from bulkhead import BulkheadFull
+import audit
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_IN_FLIGHT_PER_HOST = 4
+MAX_ITEMS_PER_JOB = 5000
+# Finished jobs beyond this count are forgotten, oldest first
+MAX_JOBS_KEPT = 20
+# Treat tokens expiring within this many seconds as already expired
+TOKEN_EXPIRY_LEEWAY = 60
+
+PURCHASE_HOST = urlparse(BASE_URL).hostname
+
+# Jobs live in the memory of the worker that started them
+_jobs = {}
+_jobs_lock = threading.Lock()
+_limiter = None
+_limiter_lock = threading.Lock()
+
+class HostConcurrencyLimiter:
+    """Caps the number of in-flight calls per upstream host."""
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_in_flight)
+            return self._semaphores[host]
+
+    @contextmanager
+    def slot(self, host: str):
+        semaphore = self._semaphore(host)
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+def _get_limiter(max_in_flight: int) -> HostConcurrencyLimiter:
+    # One limiter per process so concurrent jobs share the same per-host budget.
+    # A changed setting gets a fresh limiter; jobs already running keep the old one.
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None or _limiter.max_in_flight != max_in_flight:
+            _limiter = HostConcurrencyLimiter(max_in_flight)
+        return _limiter
+
+class BulkPurchaseJob:
+    """Tracks the progress and per-item results of one bulk purchase run."""
+    def __init__(self, items: list, submitted_by: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.submitted_by = submitted_by
+        self.created_at = time.time()
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.items = [
+            {
+                "index": i + 1,
+                "phone_number": phone_number,
+                "package_code": package_code,
+                "status": "pending",
+                "message": "",
+                "price": None,
+                "transaction_id": None,
+                "duration": None,
+            }
+            for i, (phone_number, package_code) in enumerate(items)
+        ]
+
+    def update_item(self, item: dict, **changes):
+        with self.lock:
+            item.update(changes)
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def counts(self) -> dict:
+        with self.lock:
+            counts = {"pending": 0, "running": 0, "success": 0, "failed": 0, "unknown": 0, "skipped": 0}
+            for item in self.items:
+                counts[item["status"]] += 1
+        return counts
+
+    def to_dict(self) -> dict:
+        counts = self.counts()
+        with self.lock:
+            items = [dict(item) for item in self.items]
+        return {
+            "id": self.id,
+            "submitted_by": self.submitted_by,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "done": self.done,
+            "total": len(items),
+            "counts": counts,
+            "items": items,
+        }
+
+def parse_bulk_items(text: str) -> list:
+    """
+    Parses one `phone_number,package_code` pair per line.
+    Blank lines and lines starting with '#' are ignored. Raises ValueError on bad input.
+    """
+    items = []
+    for line_no, raw_line in enumerate(text.splitlines(), start=1):
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [part.strip() for part in line.replace(";", ",").split(",")]
+        if len(parts) != 2 or not all(parts):
+            raise ValueError(f"Line {line_no}: expected 'phone_number,package_code'.")
+        phone_number, package_code = parts
+        if not phone_number.startswith("628") or not phone_number.isdigit():
+            raise ValueError(f"Line {line_no}: invalid phone number '{phone_number}'.")
+        items.append((phone_number, package_code))
+
+    if not items:
+        raise ValueError("No purchase lines were provided.")
+    if len(items) > MAX_ITEMS_PER_JOB:
+        raise ValueError(f"Too many lines ({len(items)}). The limit is {MAX_ITEMS_PER_JOB} per batch.")
+    return items
+
+def tokens_are_valid(tokens: dict) -> bool:
+    """Checks that the stored id_token is present and not (about to be) expired."""
+    if not tokens or "access_token" not in tokens or "id_token" not in tokens:
+        return False
+    try:
+        payload_b64 = tokens["id_token"].split(".")[1]
+        payload_b64 += "=" * (-len(payload_b64) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload_b64))
+    except (IndexError, ValueError):
+        return False
+    exp = claims.get("exp")
+    return exp is None or exp - TOKEN_EXPIRY_LEEWAY > time.time()
+
+def _package_prices(codes: set) -> dict:
+    codes = list(codes)
+    prices = {}
+    conn = get_db_connection()
+    # Chunk to stay under SQLite's bound-parameter limit on large batches
+    for i in range(0, len(codes), 500):
+        chunk = codes[i:i + 500]
+        placeholders = ",".join("?" for _ in chunk)
+        rows = conn.execute(
+            f'SELECT code, price, admin_price FROM packages WHERE code IN ({placeholders})',
+            chunk
+        ).fetchall()
+        for row in rows:
+            prices[row['code']] = row['admin_price'] if row['admin_price'] is not None else row['price']
+    conn.close()
+    return prices
+
+def _run_item(job: BulkPurchaseJob, item: dict, tokens: dict, price: int, limiter: HostConcurrencyLimiter):
+    # Runs on a pool thread whose future nobody reads, so every exit must leave
+    # the item with a final status instead of letting an exception vanish.
+    started = time.monotonic()
+    phone_number = item["phone_number"]
+    reserved = False
+    try:
+        job.update_item(item, status="running", price=price)
+
+        # The balance is committed before the provider call so that no SQLite
+        # write lock is held while waiting on the network.
+        new_balance = reserve_balance(phone_number, price)
+        if new_balance is None:
+            job.update_item(item, status="failed", message="Insufficient balance.",
+                            duration=time.monotonic() - started)
+            return
+        reserved = True
+        audit.record('balance', phone_number=phone_number, package_code=item["package_code"],
+                     old_value=new_balance + price, new_value=new_balance,
+                     actor=job.submitted_by, detail={'source': 'bulk_purchase', 'job_id': job.id})
+        publish_balance(phone_number)
+
+        try:
+            with limiter.slot(PURCHASE_HOST):
+                result = purchase_package(tokens, item["package_code"])
+        except PurchaseOutcomeUnknown as e:
+            # The settlement may have gone through, so the reserved balance is kept for review
+            logging.error("Bulk purchase %s item %s has an unknown outcome: %s", job.id, item["index"], e)
+            job.update_item(item, status="unknown", message=f"{e} Balance kept pending review.",
+                            duration=time.monotonic() - started)
+            publish(phone_number, "purchase", {"status": "unknown", "package": item["package_code"], "message": str(e)})
+            return
+        except Exception as e:
+            refunded_balance = refund_balance(phone_number, price)
+            reserved = False
+            audit.record('balance', phone_number=phone_number, package_code=item["package_code"],
+                         old_value=refunded_balance - price, new_value=refunded_balance,
+                         actor=job.submitted_by, detail={'source': 'bulk_purchase_refund', 'job_id': job.id})
+            message = str(e) if isinstance(e, (APIError, BulkheadFull)) else f"Unexpected error: {e}"
+            logging.error("Bulk purchase %s item %s failed: %s", job.id, item["index"], message)
+            job.update_item(item, status="failed", message=f"{message} Balance refunded.",
+                            duration=time.monotonic() - started)
+            publish_balance(phone_number)
+            publish(phone_number, "purchase", {"status": "failed", "package": item["package_code"], "message": message})
+            return
+
+        transaction_id = result.get('data', {}).get('transaction_id', 'N/A')
+        job.update_item(item, status="success", message="Purchased.", transaction_id=transaction_id,
+                        duration=time.monotonic() - started)
+        publish(phone_number, "purchase", {
+            "status": "success", "package": item["package_code"], "transaction_id": transaction_id,
+        })
+    except Exception as e:
+        # Local failures, e.g. "database is locked" while reserving or refunding
+        logging.error("Bulk purchase %s item %s hit an internal error: %s", job.id, item["index"], e)
+        if reserved:
+            # Only reached if the refund still failed after its retries
+            message = f"Internal error: {e}. Rp {price:,} is still deducted and needs a manual refund."
+        else:
+            message = f"Internal error: {e}. Balance not charged."
+        job.update_item(item, status="failed", message=message, duration=time.monotonic() - started)
+
+def _run_job(job: BulkPurchaseJob, max_workers: int, max_in_flight_per_host: int):
+    limiter = _get_limiter(max_in_flight_per_host)
+    try:
+        phone_numbers = {item["phone_number"] for item in job.items}
+        tokens_by_phone = get_user_tokens(phone_numbers)
+        prices = _package_prices({item["package_code"] for item in job.items})
+
+        runnable = []
+        for item in job.items:
+            tokens = tokens_by_phone.get(item["phone_number"])
+            price = prices.get(item["package_code"])
+            if price is None:
+                job.update_item(item, status="skipped", message="Package not found.")
+            elif not tokens_are_valid(tokens):
+                job.update_item(item, status="skipped", message="No valid stored login for this number.")
+            else:
+                runnable.append((item, tokens, price))
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"bulk-{job.id}") as executor:
+            for item, tokens, price in runnable:
+                executor.submit(_run_item, job, item, tokens, price, limiter)
+    except Exception as e:
+        logging.error("Bulk purchase %s aborted: %s", job.id, e)
+        for item in job.items:
+            if item["status"] == "pending":
+                job.update_item(item, status="failed", message=f"Job aborted: {e}")
+    finally:
+        job.finished_at = time.time()
+        counts = job.counts()
+        logging.info("Bulk purchase %s finished: %s succeeded, %s failed, %s unknown, %s skipped.",
+                     job.id, counts["success"], counts["failed"], counts["unknown"], counts["skipped"])
+
+def start_bulk_purchase(items: list, submitted_by: str,
+                        max_workers: int = DEFAULT_MAX_WORKERS,
+                        max_in_flight_per_host: int = DEFAULT_MAX_IN_FLIGHT_PER_HOST) -> BulkPurchaseJob:
+    """Starts a bulk purchase in the background and returns its job handle."""
+    job = BulkPurchaseJob(items, submitted_by)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        finished = [j for j in _jobs.values() if j.done]
+        for old_job in finished[:max(0, len(_jobs) - MAX_JOBS_KEPT)]:
+            del _jobs[old_job.id]
+
+    logging.info("Starting bulk purchase %s with %s items.", job.id, len(job.items))
+    threading.Thread(
+        target=_run_job, args=(job, max_workers, max_in_flight_per_host),
+        name=f"bulk-{job.id}", daemon=True
+    ).start()
+    return job
+
+def get_job(job_id: str):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def list_jobs() -> list:
+    with _jobs_lock:
+        return sorted(_jobs.values(), key=lambda j: j.created_at, reverse=True)
@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+class BulkheadFull(Exception):
+    """Raised when a dependency's bulkhead has no free slot within its wait budget."""
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"The {name} service is busy. Please try again in a few seconds.")
+        self.name = name
+        self.retry_after = retry_after
+
+# Set once a call with side effects upstream (a payment settlement) has been
+# sent; from then on this context waits for slots instead of being shed.
+_shedding_disabled = contextvars.ContextVar("bulkhead_shedding_disabled", default=False)
+
+@contextmanager
+def no_shedding():
+    """Within this block (and threads started with a copy of its context), bulkheads wait instead of rejecting."""
+    token = _shedding_disabled.set(True)
+    try:
+        yield
+    finally:
+        _shedding_disabled.reset(token)
+
+class Bulkhead:
+    """Bounded concurrency for calls to one upstream dependency."""
+    def __init__(self, name: str, max_concurrent: int, max_wait: float, retry_after: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @contextmanager
+    def guard(self):
+        with self._lock:
+            self.waiting += 1
+        if _shedding_disabled.get():
+            acquired = self._semaphore.acquire()
+        else:
+            acquired = self._semaphore.acquire(timeout=self.max_wait)
+        with self._lock:
+            self.waiting -= 1
+            if acquired:
+                self.in_flight += 1
+                self.admitted += 1
+            else:
+                self.rejected += 1
+        if not acquired:
+            logging.warning("Bulkhead %s saturated; rejecting call.", self.name)
+            raise BulkheadFull(self.name, self.retry_after)
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._semaphore.release()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+def _from_env(name: str, default_concurrent: int) -> Bulkhead:
+    prefix = f"BULKHEAD_{name.upper()}"
+    return Bulkhead(
+        name,
+        max_concurrent=int(os.environ.get(f"{prefix}_MAX_CONCURRENT", default_concurrent)),
+        max_wait=float(os.environ.get(f"{prefix}_MAX_WAIT", 1.0)),
+        retry_after=int(os.environ.get(f"{prefix}_RETRY_AFTER", 5)),
+    )
+
+# One bulkhead per upstream dependency, per worker process
+BULKHEADS = {
+    "xdata": _from_env("xdata", 16),
+    "myxl": _from_env("myxl", 16),
+    "ciam": _from_env("ciam", 8),
+}
+
+def bulkhead(name: str):
+    """Context manager that admits the call into the named dependency's bulkhead."""
+    return BULKHEADS[name].guard()
+
+def ensure_capacity(*names: str):
+    """
+    Raises BulkheadFull unless each named bulkhead can admit a call right now.
+    Multi-step flows call this up front so load is shed before their first step.
+    """
+    for name in names:
+        with BULKHEADS[name].guard():
+            pass
+
+def occupancy() -> dict:
+    """Returns current per-dependency occupancy for monitoring."""
+    return {
+        "timestamp": time.time(),
+        "pid": os.getpid(),
+        "bulkheads": {name: b.snapshot() for name, b in BULKHEADS.items()},
+    }
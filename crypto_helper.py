@@ -1,17 +1,27 @@
-import os, hmac, hashlib, requests, brotli, zlib, base64
+import os, hmac, json, hashlib, base64
 from datetime import datetime, timezone, timedelta
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad
+
+from bulkhead import bulkhead
+from xdata_pool import XdataPool, EndpointFailure
+
+# requests, brotli/zlib and pycryptodome are imported inside the functions that
+# use them so that importing this module stays cheap on worker boot.
 
 API_KEY = "vT8tINqHaOxXbGE7eOWAhA=="
 AX_API_SIG_KEY_ASCII = b"18b4d589826af50241177961590e6693"
 
-XDATA_ENCRYPT_URL = "https://myxldecrypt.fuyuki.pw/encrypt"
-XDATA_DECRYPT_URL = "https://myxldecrypt.fuyuki.pw/decrypt"
-XDATA_ENCRYPT_SIGN_URL = "https://myxldecrypt.fuyuki.pw/encryptsign"
+# Comma-separated base URLs of interchangeable xdata encrypt/decrypt mirrors
+XDATA_ENDPOINTS = [
+    url.strip() for url in os.environ.get("XDATA_ENDPOINTS", "https://myxldecrypt.fuyuki.pw").split(",") if url.strip()
+]
+XDATA_ENCRYPT_PATH = "encrypt"
+XDATA_DECRYPT_PATH = "decrypt"
+XDATA_ENCRYPT_SIGN_PATH = "encryptsign"
+
+xdata_pool = XdataPool(XDATA_ENDPOINTS, guard=lambda: bulkhead("xdata"))
 
 AES_KEY_ASCII = "5dccbf08920a5527"
-BLOCK = AES.block_size
+BLOCK = 16 # AES.block_size
 
 def random_iv_hex16() -> str:
     return os.urandom(8).hex()
@@ -25,6 +35,9 @@ def b64(data: bytes, urlsafe: bool) -> str:
 
 
 def build_encrypted_field(iv_hex16: str | None = None, urlsafe_b64: bool = False) -> str:
+    from Crypto.Cipher import AES
+    from Crypto.Util.Padding import pad
+
     key = AES_KEY_ASCII.encode("ascii")
     iv_hex = iv_hex16 or random_iv_hex16()
     iv = iv_hex.encode("ascii") 
@@ -39,16 +52,109 @@ def java_like_timestamp(now: datetime) -> str:
     tz = now.strftime("%z"); tz_colon = tz[:-2] + ":" + tz[-2:] if tz else "+00:00"
     return now.strftime(f"%Y-%m-%dT%H:%M:%S.{ms2}") + tz_colon
 
-def decode_response(response):
-    encoding = response.headers.get("Content-Encoding", "").lower()
-    if encoding == "br":
-        return brotli.decompress(response.content).decode("utf-8")
-    elif encoding == "gzip":
-        return zlib.decompress(response.content, zlib.MAX_WBITS | 16).decode("utf-8")
-    elif encoding == "deflate":
-        return zlib.decompress(response.content).decode("utf-8")
-    else:
-        return response.text
+# Upper bound for any upstream body, measured after decompression
+MAX_RESPONSE_BYTES = int(os.environ.get("MAX_RESPONSE_BYTES", 16 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 16 * 1024
+# How much of an error response body is kept for log and error messages
+ERROR_BODY_PREVIEW_BYTES = 1024
+
+class ResponseTooLarge(Exception):
+    """Raised when an upstream response body exceeds MAX_RESPONSE_BYTES."""
+    pass
+
+class _Decompressor:
+    """Incremental decompressor for a single Content-Encoding."""
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            import brotli
+            self._obj = brotli.Decompressor()
+        elif encoding in ("gzip", "x-gzip"):
+            import zlib
+            self._obj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        elif encoding == "deflate":
+            import zlib
+            self._obj = zlib.decompressobj()
+        else:
+            self._obj = None
+
+    def process(self, chunk: bytes, max_length: int):
+        """
+        Yields the decompressed output of chunk in pieces of about max_length
+        at most, so the caller can stop before a small compressed body
+        expands in memory.
+        """
+        if self._obj is None:
+            yield chunk
+        elif self.encoding == "br":
+            yield self._obj.process(chunk, output_buffer_limit=max_length)
+            # Output held back by the limit is drained with empty input
+            while not self._obj.can_accept_more_data():
+                yield self._obj.process(b"", output_buffer_limit=max_length)
+        else:
+            data = chunk
+            while data:
+                yield self._obj.decompress(data, max_length)
+                data = self._obj.unconsumed_tail
+
+    def flush(self) -> bytes:
+        if self._obj is None or self.encoding == "br":
+            return b""
+        return self._obj.flush()
+
+def read_response_body(response, max_bytes: int = MAX_RESPONSE_BYTES, truncate: bool = False) -> bytes:
+    """
+    Reads a response opened with `stream=True` straight from `response.raw`,
+    decompressing incrementally and aborting once `max_bytes` is exceeded.
+    With `truncate=True` the first `max_bytes` are returned instead of raising.
+    """
+    if getattr(response, "_content_consumed", False):
+        # Body already buffered (and decoded) by requests; just enforce the limit.
+        body = response.content
+        if len(body) > max_bytes:
+            if truncate:
+                return body[:max_bytes]
+            raise ResponseTooLarge(f"Response body exceeds {max_bytes} bytes.")
+        return body
+
+    encoding = response.headers.get("Content-Encoding", "").lower().strip()
+    content_length = response.headers.get("Content-Length")
+    if (not truncate and encoding in ("", "identity") and content_length and content_length.isdigit()
+            and int(content_length) > max_bytes):
+        raise ResponseTooLarge(f"Response body of {content_length} bytes exceeds {max_bytes} bytes.")
+
+    decompressor = _Decompressor(encoding)
+    parts = []
+    size = 0
+    try:
+        for chunk in response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+            # Asking for one byte more than what's left is enough to detect an oversized body
+            for data in decompressor.process(chunk, max_bytes - size + 1):
+                size += len(data)
+                if size > max_bytes:
+                    if truncate:
+                        parts.append(data[:len(data) - (size - max_bytes)])
+                        return b"".join(parts)
+                    raise ResponseTooLarge(f"Response body exceeds {max_bytes} bytes.")
+                parts.append(data)
+        tail = decompressor.flush()
+        if size + len(tail) > max_bytes:
+            if truncate:
+                parts.append(tail[:max_bytes - size])
+                return b"".join(parts)
+            raise ResponseTooLarge(f"Response body exceeds {max_bytes} bytes.")
+        parts.append(tail)
+    finally:
+        response.close()
+    return b"".join(parts)
+
+def read_error_text(response) -> str:
+    """Returns the start of an error response body, without reading the rest of it."""
+    body = read_response_body(response, ERROR_BODY_PREVIEW_BYTES, truncate=True)
+    return body.decode("utf-8", errors="replace")
+
+def decode_response(response, max_bytes: int = MAX_RESPONSE_BYTES) -> str:
+    return read_response_body(response, max_bytes).decode("utf-8")
 
 def ts_gmt7_without_colon(dt: datetime) -> str:
     if dt.tzinfo is None:
@@ -71,6 +177,8 @@ def encryptsign_xdata(
         id_token: str,
         payload: dict
     ) -> str:
+    import requests
+
     headers = {
         "Content-Type": "application/json",
     }
@@ -82,27 +190,57 @@ def encryptsign_xdata(
         "body": payload
     }
 
-    response = requests.request("POST", XDATA_ENCRYPT_SIGN_URL, json=request_body, headers=headers, timeout=30)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise Exception(f"Encryption failed: {response.text}")
+    def attempt(url: str):
+        try:
+            with requests.request("POST", url, json=request_body, headers=headers, timeout=30, stream=True) as response:
+                if response.status_code == 200:
+                    return json.loads(read_response_body(response))
+                elif response.status_code >= 500:
+                    raise EndpointFailure(f"Encryption failed on {url}: {response.status_code}")
+                else:
+                    raise Exception(f"Encryption failed: {read_error_text(response)}")
+        except requests.RequestException as e:
+            raise EndpointFailure(f"Encryption request to {url} failed: {e}")
+
+    # Signing isn't safe to duplicate, so it only fails over; it is never hedged
+    return xdata_pool.call(XDATA_ENCRYPT_SIGN_PATH, attempt)
     
 def decrypt_xdata(encrypted_payload: dict) -> dict:
     if not isinstance(encrypted_payload, dict) or "xdata" not in encrypted_payload or "xtime" not in encrypted_payload:
         raise ValueError("Invalid encrypted data format. Expected a dictionary with 'xdata' and 'xtime' keys.")
     
+    return decrypt_xdata_raw(json.dumps(encrypted_payload).encode("utf-8"))
+
+def decrypt_xdata_raw(encrypted_body: bytes, max_bytes: int = MAX_RESPONSE_BYTES) -> dict:
+    """
+    Decrypts an encrypted API response body as received, without parsing and
+    re-serializing it first. The decrypted result is read with the same
+    streaming, size-bounded reader.
+    """
+    # Cheap sanity check instead of a full JSON parse of the encrypted body
+    if b'"xdata"' not in encrypted_body or b'"xtime"' not in encrypted_body:
+        raise ValueError("Invalid encrypted data format. Expected a JSON object with 'xdata' and 'xtime' keys.")
+
+    import requests
+
     headers = {
         "Content-Type": "application/json",
     }
     
-    response = requests.request("POST", XDATA_DECRYPT_URL, json=encrypted_payload, headers=headers, timeout=30)
-    
-    if response.status_code == 200:
-        return response.json().get("plaintext")
-    else:
-        raise Exception(f"Decryption failed: {response.text}")
+    def attempt(url: str):
+        try:
+            with requests.request("POST", url, data=encrypted_body, headers=headers, timeout=30, stream=True) as response:
+                if response.status_code == 200:
+                    return json.loads(read_response_body(response, max_bytes)).get("plaintext")
+                elif response.status_code >= 500:
+                    raise EndpointFailure(f"Decryption failed on {url}: {response.status_code}")
+                else:
+                    raise Exception(f"Decryption failed: {read_error_text(response)}")
+        except requests.RequestException as e:
+            raise EndpointFailure(f"Decryption request to {url} failed: {e}")
+
+    # Decryption is idempotent, so a slow mirror is hedged against the next fastest one
+    return xdata_pool.hedged_call(XDATA_DECRYPT_PATH, attempt)
 
 def make_x_signature_payment(access_token: str, sig_time_sec: int, package_code: str, token_payment:str) -> str:
     k = b"KRw1fXkLSwZLCU52GiEaNRsXFnURAhUUAH9MFmZZK2gPRDAIBjkMEBYdQkoWYmh2YhQCBEIKLDRbGR0zAk1OV2dXCEUzAz9THSsGGDwgbzVvYR9fQERbcgIxcB1aEh4rEB85dXRjdVsJQgM5DxAUOh4mdS9helFqd1VDRmA2AyMYKBoTE24YPWFLXUdpF2RGJGYhRnggDF0KGDE/FgUVZmFjd3ogKFo+DAkaPlY5PEoXWA4BQ0Y1JCVGPgwJGmAbOSBCVk1TFUtQNS0="
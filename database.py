@@ -1,11 +1,13 @@
+import json
+import time
 import sqlite3
 import logging
 
 DATABASE_URL = "regar_store.db"
 
-def get_db_connection():
-    """Creates a database connection."""
-    conn = sqlite3.connect(DATABASE_URL)
+def get_db_connection(timeout: float = 5.0):
+    """Creates a database connection that waits up to timeout seconds for a locked database."""
+    conn = sqlite3.connect(DATABASE_URL, timeout=timeout)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -34,6 +36,76 @@ def init_db():
     """)
     logging.info("Packages table created or already exists.")
 
+    # Create user_tokens table (latest MyXL tokens per user, used for bulk purchases)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_tokens (
+        phone_number TEXT PRIMARY KEY,
+        tokens TEXT NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    """)
+    logging.info("User tokens table created or already exists.")
+
+    # Create events table (live dashboard updates, also the cross-worker change feed)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone_number TEXT NOT NULL,
+        type TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        origin TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_phone_id ON events (phone_number, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at)")
+    logging.info("Events table created or already exists.")
+
+    # Catalog version: bumped by triggers on any change to packages, so cached
+    # renderings of the package list can be invalidated across workers
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    triggers = {
+        "INSERT": "",
+        # Package syncs rewrite every row; only count updates that change something
+        "UPDATE": "WHEN OLD.name IS NOT NEW.name OR OLD.price IS NOT NEW.price OR OLD.admin_price IS NOT NEW.admin_price",
+        "DELETE": "",
+    }
+    for action, condition in triggers.items():
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS packages_{action.lower()}_bump_version
+        AFTER {action} ON packages {condition}
+        BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END
+        """)
+    logging.info("Catalog version table created or already exists.")
+
+    # Create audit_log table (append-only history of balance and price changes)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS audit_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        kind TEXT NOT NULL,
+        phone_number TEXT,
+        package_code TEXT,
+        old_value INTEGER,
+        new_value INTEGER,
+        delta INTEGER,
+        actor TEXT,
+        request_id TEXT,
+        detail TEXT
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_phone_ts ON audit_log (phone_number, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_ts ON audit_log (ts)")
+    logging.info("Audit log table created or already exists.")
+
     conn.commit()
     conn.close()
 
@@ -44,7 +116,92 @@ def get_all_packages():
     conn.close()
     return packages
 
+def get_catalog_version() -> int:
+    """Returns a counter that changes whenever the packages table changes."""
+    conn = get_db_connection()
+    row = conn.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()
+    conn.close()
+    return row['version'] if row else 0
+
+def save_user_tokens(phone_number: str, tokens: dict):
+    """Stores the latest MyXL tokens for a user, replacing any previous ones."""
+    conn = get_db_connection()
+    conn.execute(
+        'INSERT OR REPLACE INTO user_tokens (phone_number, tokens, updated_at) VALUES (?, ?, ?)',
+        (phone_number, json.dumps(tokens), int(time.time()))
+    )
+    conn.commit()
+    conn.close()
+
+def is_locked_error(error: Exception) -> bool:
+    """True for SQLite's transient "database is locked"/"busy" errors, which are worth retrying."""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+# A refund must not be lost to a briefly locked database
+REFUND_ATTEMPTS = 6
+REFUND_RETRY_DELAY = 0.25
+
+def reserve_balance(phone_number: str, amount: int) -> int | None:
+    """
+    Deducts amount if the user can afford it and commits straight away, so no
+    write lock is held while the caller waits on the provider.
+    Returns the new balance, or None if the balance is insufficient.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.execute(
+            'UPDATE users SET balance = balance - ? WHERE phone_number = ? AND balance >= ?',
+            (amount, phone_number, amount)
+        )
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return None
+        new_balance = conn.execute('SELECT balance FROM users WHERE phone_number = ?', (phone_number,)).fetchone()['balance']
+        conn.commit()
+        return new_balance
+    finally:
+        conn.close()
+
+def refund_balance(phone_number: str, amount: int) -> int:
+    """Gives back a reserved amount, retrying while the database is locked. Returns the new balance."""
+    for attempt in range(REFUND_ATTEMPTS):
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE users SET balance = balance + ? WHERE phone_number = ?', (amount, phone_number))
+            new_balance = conn.execute('SELECT balance FROM users WHERE phone_number = ?', (phone_number,)).fetchone()['balance']
+            conn.commit()
+            return new_balance
+        except sqlite3.OperationalError as e:
+            if not is_locked_error(e) or attempt == REFUND_ATTEMPTS - 1:
+                raise
+            logging.warning("Refund of %s for %s hit a locked database; retrying.", amount, phone_number)
+            time.sleep(REFUND_RETRY_DELAY * 2 ** attempt)
+        finally:
+            conn.close()
+
+def get_user_tokens(phone_numbers: list) -> dict:
+    """Returns a mapping of phone number -> stored tokens for the given numbers."""
+    phone_numbers = list(phone_numbers)
+    result = {}
+    conn = get_db_connection()
+    # Chunk to stay under SQLite's bound-parameter limit on large batches
+    for i in range(0, len(phone_numbers), 500):
+        chunk = phone_numbers[i:i + 500]
+        placeholders = ",".join("?" for _ in chunk)
+        rows = conn.execute(
+            f'SELECT phone_number, tokens FROM user_tokens WHERE phone_number IN ({placeholders})',
+            chunk
+        ).fetchall()
+        for row in rows:
+            result[row['phone_number']] = json.loads(row['tokens'])
+    conn.close()
+    return result
+
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
+    from log_config import setup_logging
+    setup_logging()
     init_db()
     print("Database has been initialized.")
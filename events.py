@@ -0,0 +1,182 @@
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+
+from database import get_db_connection
+
+# How often each worker checks SQLite for events published by other workers
+POLL_INTERVAL = 0.5
+# Comment lines sent to idle streams so proxies don't time them out
+HEARTBEAT_INTERVAL = 15
+SUBSCRIBER_QUEUE_SIZE = 100
+# Events older than this are pruned from the events table
+EVENT_RETENTION_SECONDS = 3600
+PRUNE_INTERVAL = 300
+
+# Identifies this process so the poller doesn't re-deliver our own events
+WORKER_ID = uuid.uuid4().hex
+
+class Subscriber:
+    """One open stream's buffer of pending events."""
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # Set once events had to be dropped; the stream then ends so the
+        # browser reconnects and replays what it missed via Last-Event-ID.
+        self.overflowed = False
+
+class EventBroker:
+    """In-process pub/sub of events keyed by phone number."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, phone_number: str) -> Subscriber:
+        subscriber = Subscriber()
+        with self._lock:
+            self._subscribers.setdefault(phone_number, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, phone_number: str, subscriber: Subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(phone_number)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[phone_number]
+
+    def dispatch(self, event: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(event["phone_number"], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                # A stalled client must not hold up everyone else. Stop feeding
+                # it; its stream ends and the reconnect replays from the table.
+                subscriber.overflowed = True
+                self.unsubscribe(event["phone_number"], subscriber)
+                logging.warning("Event stream for %s overflowed; closing it.", event["phone_number"])
+
+broker = EventBroker()
+
+_poller_started = False
+_poller_lock = threading.Lock()
+
+def publish(phone_number: str, event_type: str, data: dict):
+    """
+    Records an event for a user and delivers it to this worker's subscribers.
+    Other workers pick it up from the events table on their next poll.
+    """
+    payload = json.dumps(data)
+    try:
+        conn = get_db_connection()
+        cursor = conn.execute(
+            'INSERT INTO events (phone_number, type, payload, origin, created_at) VALUES (?, ?, ?, ?, ?)',
+            (phone_number, event_type, payload, WORKER_ID, time.time())
+        )
+        conn.commit()
+        event_id = cursor.lastrowid
+        conn.close()
+    except Exception as e:
+        # Live updates are best effort; never fail the caller's request over them
+        logging.error("Failed to publish %s event for %s: %s", event_type, phone_number, e)
+        return
+
+    broker.dispatch({"id": event_id, "phone_number": phone_number, "type": event_type, "data": payload})
+
+def publish_balance(phone_number: str):
+    """Publishes the user's current balance as stored in the database."""
+    try:
+        conn = get_db_connection()
+        row = conn.execute('SELECT balance FROM users WHERE phone_number = ?', (phone_number,)).fetchone()
+        conn.close()
+    except Exception as e:
+        logging.error("Failed to read balance for %s: %s", phone_number, e)
+        return
+    if row is not None:
+        publish(phone_number, "balance", {"balance": row['balance']})
+
+def events_since(phone_number: str, last_event_id: int) -> list:
+    """Returns a user's stored events newer than last_event_id, oldest first."""
+    conn = get_db_connection()
+    rows = conn.execute(
+        'SELECT id, phone_number, type, payload FROM events WHERE phone_number = ? AND id > ? ORDER BY id',
+        (phone_number, last_event_id)
+    ).fetchall()
+    conn.close()
+    return [{"id": row['id'], "phone_number": row['phone_number'], "type": row['type'], "data": row['payload']} for row in rows]
+
+def _poll_loop():
+    conn = get_db_connection()
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+    data_version = None
+    last_prune = 0
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            # data_version only changes when another connection commits, so
+            # idle polls are a single cheap pragma.
+            current_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if current_version != data_version:
+                data_version = current_version
+                rows = conn.execute(
+                    'SELECT id, phone_number, type, payload, origin FROM events WHERE id > ? ORDER BY id',
+                    (last_id,)
+                ).fetchall()
+                for row in rows:
+                    last_id = row['id']
+                    if row['origin'] != WORKER_ID:
+                        broker.dispatch({"id": row['id'], "phone_number": row['phone_number'],
+                                         "type": row['type'], "data": row['payload']})
+
+            if time.time() - last_prune > PRUNE_INTERVAL:
+                last_prune = time.time()
+                conn.execute('DELETE FROM events WHERE created_at < ?', (time.time() - EVENT_RETENTION_SECONDS,))
+                conn.commit()
+        except Exception as e:
+            logging.error("Event poller error: %s", e)
+
+def _ensure_poller():
+    global _poller_started
+    if _poller_started:
+        return
+    with _poller_lock:
+        if not _poller_started:
+            threading.Thread(target=_poll_loop, name="event-poller", daemon=True).start()
+            _poller_started = True
+
+def _format_sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {event['data']}\n\n"
+
+def stream_events(phone_number: str, last_event_id: int | None = None, initial_events: list = ()):
+    """Generator yielding SSE-formatted events for one user until the client disconnects."""
+    _ensure_poller()
+    subscriber = broker.subscribe(phone_number)
+    try:
+        # Tell the browser how long to wait before reconnecting
+        yield "retry: 3000\n\n"
+        for event in initial_events:
+            yield f"event: {event['type']}\ndata: {event['data']}\n\n"
+        replayed_up_to = 0
+        if last_event_id is not None:
+            for event in events_since(phone_number, last_event_id):
+                replayed_up_to = event["id"]
+                yield _format_sse(event)
+
+        while not subscriber.overflowed:
+            try:
+                event = subscriber.queue.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if subscriber.overflowed:
+                # Events were dropped after this one; end the stream and let the reconnect replay them
+                break
+            # Skip anything already sent during the replay above
+            if event["id"] > replayed_up_to:
+                yield _format_sse(event)
+    finally:
+        broker.unsubscribe(phone_number, subscriber)
@@ -0,0 +1,32 @@
+import threading
+from collections import OrderedDict
+
+class FragmentCache:
+    """
+    Small in-process cache of rendered HTML fragments.
+    Keys should embed a version so stale entries are simply never asked for again.
+    """
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        # Rendering happens outside the lock; a concurrent miss may render twice,
+        # which is cheaper than serializing every dashboard request behind it.
+        html = render()
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
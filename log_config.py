@@ -0,0 +1,124 @@
+import os
+import json
+import queue
+import random
+import atexit
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", os.path.join("logs", "app.log"))
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10000
+
+# High-volume INFO lines, keyed by their (unformatted) message template,
+# mapped to the fraction of records that should be kept.
+SAMPLED_MESSAGES = {
+    "Sending API request to %s": 0.1,
+    "Fetching profile...": 0.1,
+    "Fetching balance...": 0.1,
+    "Fetching package details for: %s": 0.1,
+}
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_listener = None
+
+class RequestIdFilter(logging.Filter):
+    """Attaches the current request id to every record."""
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Drops a share of high-volume INFO records according to SAMPLED_MESSAGES."""
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno != logging.INFO:
+            return True
+        rate = self.rates.get(record.msg)
+        if rate is None:
+            return True
+        return random.random() < rate
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that defers message formatting to the listener thread."""
+    def prepare(self, record):
+        # Only the request id is bound on the caller's thread; the message itself
+        # is formatted in the background so request threads never pay for it.
+        # Args that can't cross threads safely are the caller's responsibility.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request thread on logging; drop instead.
+            pass
+
+def setup_logging():
+    """
+    Configures the root logger to hand records to a background writer thread.
+    Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_dir = os.path.dirname(LOG_FILE)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    file_handler = RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(JSONFormatter())
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s"
+    ))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SamplingFilter(SAMPLED_MESSAGES))
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """Flushes pending records and stops the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
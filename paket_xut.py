@@ -1,5 +1,6 @@
 import logging
 from api_request import get_family, APIError
+from bulkhead import BulkheadFull
 
 PACKAGE_FAMILY_CODE = "08a3b1e6-8e78-4e45-a540-b40f06871cfe"
 
@@ -38,11 +39,13 @@ def get_package_xut(tokens: dict):
                         })
                         
                         start_number += 1
-        logging.info(f"Found and formatted {len(packages)} XUT packages.")
+        logging.info("Found and formatted %s XUT packages.", len(packages))
         return packages
     except APIError as e:
-        logging.error(f"API Error while fetching XUT packages: {e}")
+        logging.error("API Error while fetching XUT packages: %s", e)
         raise  # Re-raise the exception to be handled by the caller
+    except BulkheadFull:
+        raise
     except Exception as e:
-        logging.error(f"An unexpected error occurred in get_package_xut: {e}")
+        logging.error("An unexpected error occurred in get_package_xut: %s", e)
         raise APIError("An unexpected error occurred while formatting packages.")
\ No newline at end of file
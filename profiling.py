@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import cProfile
+import threading
+from collections import Counter
+from flask import request, g
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Written by the admin panel, read by every worker; this is how all workers get armed
+CONTROL_FILE = os.path.join(PROFILE_DIR, "control.json")
+# How often a worker re-checks the control file
+CONTROL_CHECK_INTERVAL = 1.0
+DEFAULT_SAMPLE_INTERVAL = 0.01
+MAX_PROFILED_REQUESTS = 500
+MAX_SAMPLE_SECONDS = 300
+
+_state_lock = threading.Lock()
+_control = None
+_control_mtime = None
+_last_control_check = 0.0
+_cprofile_remaining = 0
+_consumed_control_id = None
+_sampler = None
+
+def arm(mode: str, endpoints: list, requests_count: int = 0, seconds: float = 0,
+        interval: float = DEFAULT_SAMPLE_INTERVAL) -> dict:
+    """Arms profiling on all workers by writing a new control file."""
+    if mode not in ("cprofile", "sample"):
+        raise ValueError("Profiling mode must be 'cprofile' or 'sample'.")
+    if mode == "cprofile" and not 0 < requests_count <= MAX_PROFILED_REQUESTS:
+        raise ValueError(f"Number of requests must be between 1 and {MAX_PROFILED_REQUESTS}.")
+    if mode == "sample" and not 1 <= seconds <= MAX_SAMPLE_SECONDS:
+        raise ValueError(f"Sampling window must be between 1 and {MAX_SAMPLE_SECONDS} seconds.")
+
+    control = {
+        "id": uuid.uuid4().hex[:8],
+        "mode": mode,
+        "endpoints": sorted(endpoints),
+        "requests": requests_count,
+        "until": time.time() + seconds if mode == "sample" else None,
+        "interval": interval,
+        "armed_at": time.time(),
+    }
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    tmp_path = f"{CONTROL_FILE}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(control, f)
+    os.replace(tmp_path, CONTROL_FILE)
+    logging.info("Profiling armed: %s", control)
+    return control
+
+def disarm():
+    try:
+        os.remove(CONTROL_FILE)
+    except FileNotFoundError:
+        pass
+
+def current_control() -> dict | None:
+    try:
+        with open(CONTROL_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _refresh_control():
+    """Picks up control file changes at most once per CONTROL_CHECK_INTERVAL."""
+    global _control, _control_mtime, _last_control_check, _cprofile_remaining, _consumed_control_id
+    now = time.monotonic()
+    if now - _last_control_check < CONTROL_CHECK_INTERVAL:
+        return
+    _last_control_check = now
+    try:
+        mtime = os.stat(CONTROL_FILE).st_mtime
+    except FileNotFoundError:
+        if _control is not None:
+            _stop_sampler()
+        _control = None
+        _control_mtime = None
+        return
+    if mtime == _control_mtime:
+        return
+    _control_mtime = mtime
+    _control = current_control()
+    if _control and _control["id"] != _consumed_control_id:
+        _consumed_control_id = _control["id"]
+        # A re-arm ends the previous window even if it hasn't run out yet
+        _stop_sampler()
+        if _control["mode"] == "cprofile":
+            _cprofile_remaining = _control["requests"]
+        elif _control["mode"] == "sample":
+            _start_sampler(_control)
+
+def _matches(control: dict, endpoint: str | None) -> bool:
+    return endpoint is not None and (not control["endpoints"] or endpoint in control["endpoints"])
+
+def _output_path(kind: str, endpoint: str, ext: str) -> str:
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    safe_endpoint = "".join(c if c.isalnum() or c in "-_" else "_" for c in endpoint)
+    return os.path.join(PROFILE_DIR, f"{kind}-{safe_endpoint}-{stamp}-{os.getpid()}-{uuid.uuid4().hex[:6]}.{ext}")
+
+def before_request():
+    global _cprofile_remaining
+    with _state_lock:
+        _refresh_control()
+        control = _control
+        if control is None or not _matches(control, request.endpoint):
+            return
+
+        if control["mode"] == "sample":
+            if _sampler is not None and _sampler.is_alive():
+                _sampler.threads[threading.get_ident()] = request.endpoint
+            return
+        if _cprofile_remaining <= 0:
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another request is already being profiled; this one doesn't count
+            return
+        # Only requests that actually get profiled use up the budget
+        _cprofile_remaining -= 1
+    g.profiler = profiler
+
+def teardown_request(exc):
+    with _state_lock:
+        if _sampler is not None:
+            _sampler.threads.pop(threading.get_ident(), None)
+
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    path = _output_path("cprofile", request.endpoint or "unknown", "pstats")
+    try:
+        profiler.dump_stats(path)
+        logging.info("Wrote cProfile stats to %s", path)
+    except OSError as e:
+        logging.error("Failed to write profile %s: %s", path, e)
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class _Sampler(threading.Thread):
+    """Periodically samples the stacks of request threads into collapsed-stack counts."""
+    def __init__(self, control: dict):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.control = control
+        self.stacks = Counter()
+        self.samples = 0
+        # thread id -> endpoint, for request threads this sampler should look at
+        self.threads = {}
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Ends the window early; what was sampled so far is still written."""
+        self._stopped.set()
+
+    def run(self):
+        interval = self.control.get("interval") or DEFAULT_SAMPLE_INTERVAL
+        until = self.control["until"]
+        while time.time() < until and not self._stopped.is_set():
+            with _state_lock:
+                targets = dict(self.threads)
+            if targets:
+                frames = sys._current_frames()
+                for thread_id, endpoint in targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    stack.append(endpoint)
+                    self.stacks[";".join(reversed(stack))] += 1
+                    self.samples += 1
+            self._stopped.wait(interval)
+
+        self._write()
+
+    def _write(self):
+        if not self.stacks:
+            logging.info("Sampling profiler window ended with no samples.")
+            return
+        path = _output_path("sample", "+".join(self.control["endpoints"]) or "all", "collapsed")
+        try:
+            with open(path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            logging.info("Wrote %s stack samples to %s", self.samples, path)
+        except OSError as e:
+            logging.error("Failed to write samples %s: %s", path, e)
+
+def _start_sampler(control: dict):
+    global _sampler
+    if control["until"] <= time.time():
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    _sampler = _Sampler(control)
+    _sampler.start()
+
+def _stop_sampler():
+    global _sampler
+    if _sampler is not None:
+        # Not joined: the sampler takes _state_lock, which the caller holds
+        _sampler.stop()
+        _sampler = None
+
+def list_outputs() -> list:
+    """Lists collected profile files from all workers, newest first."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    outputs = []
+    for name in names:
+        if not name.endswith((".pstats", ".collapsed")):
+            continue
+        stat = os.stat(os.path.join(PROFILE_DIR, name))
+        outputs.append({"name": name, "size": stat.st_size, "mtime": stat.st_mtime})
+    return sorted(outputs, key=lambda o: o["mtime"], reverse=True)
+
+def init_profiling(app):
+    """Registers the request hooks that drive on-demand profiling."""
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,99 @@
+import time
+import sqlite3
+
+import pytest
+
+import audit
+import database
+
+@pytest.fixture(autouse=True)
+def _temp_db(monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "DATABASE_URL", str(tmp_path / "audit.db"))
+    database.init_db()
+    yield
+    audit.shutdown()
+
+def _event(i):
+    return (time.time(), "balance", "6281", None, i, i + 1, 1, "test", None, None)
+
+def _recording_writer(monkeypatch):
+    """An AuditWriter that also remembers the size of every batch it commits."""
+    writer = audit.AuditWriter()
+    batches = []
+    write = writer._write
+
+    def recording_write(conn, batch):
+        batches.append(len(batch))
+        write(conn, batch)
+
+    monkeypatch.setattr(writer, "_write", recording_write)
+    return writer, batches
+
+def _stored_count():
+    conn = database.get_db_connection()
+    count = conn.execute("SELECT COUNT(*) FROM audit_log").fetchone()[0]
+    conn.close()
+    return count
+
+def test_events_queued_together_share_batches(monkeypatch):
+    writer, batches = _recording_writer(monkeypatch)
+    for i in range(1200):
+        writer.submit(_event(i))
+    writer.start()
+    writer.stop()
+
+    assert sum(batches) == 1200
+    assert max(batches) <= audit.MAX_BATCH_SIZE
+    assert len(batches) == 3
+    assert _stored_count() == 1200
+
+def test_a_lone_event_is_written_after_the_batch_delay(monkeypatch):
+    writer, batches = _recording_writer(monkeypatch)
+    writer.start()
+    writer.submit(_event(0))
+
+    deadline = time.monotonic() + 2
+    while not batches and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert batches == [1]
+    assert _stored_count() == 1
+    writer.stop()
+
+def test_stop_flushes_pending_events(monkeypatch):
+    writer, batches = _recording_writer(monkeypatch)
+    writer.start()
+    for i in range(10):
+        writer.submit(_event(i))
+    writer.stop()
+
+    assert not writer.is_alive()
+    assert sum(batches) == 10
+    assert _stored_count() == 10
+
+def test_record_and_query_round_trip():
+    audit.record("balance", phone_number="6281", old_value=100, new_value=70, actor="admin", detail={"source": "test"})
+    audit.record("price", package_code="P1", old_value=10, new_value=12, actor="provider-sync")
+    audit.shutdown()
+
+    rows = audit.query_audit(phone_number="6281")
+    assert len(rows) == 1
+    assert rows[0]["delta"] == -30
+    assert [row["kind"] for row in audit.query_audit()] == ["price", "balance"]
+
+def test_batch_is_kept_while_the_database_is_locked(monkeypatch):
+    monkeypatch.setattr(audit, "WRITE_TIMEOUT", 0.05)
+    monkeypatch.setattr(audit, "RETRY_DELAY", 0.01)
+    writer, batches = _recording_writer(monkeypatch)
+
+    blocker = sqlite3.connect(database.DATABASE_URL)
+    blocker.execute("BEGIN IMMEDIATE")
+    writer.start()
+    writer.submit(_event(0))
+    time.sleep(0.5)
+    assert _stored_count() == 0
+    blocker.rollback()
+    blocker.close()
+    writer.stop()
+
+    assert batches == [1]
+    assert _stored_count() == 1
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+
+import database
+
+@pytest.fixture(autouse=True)
+def _temp_db(monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "DATABASE_URL", str(tmp_path / "balance.db"))
+    database.init_db()
+    conn = database.get_db_connection()
+    conn.execute("INSERT INTO users (phone_number, balance) VALUES ('6281', 5000)")
+    conn.commit()
+    conn.close()
+
+def _balance():
+    conn = database.get_db_connection()
+    balance = conn.execute("SELECT balance FROM users WHERE phone_number = '6281'").fetchone()['balance']
+    conn.close()
+    return balance
+
+def test_reserve_deducts_and_returns_new_balance():
+    assert database.reserve_balance('6281', 3000) == 2000
+    assert _balance() == 2000
+
+def test_reserve_refuses_insufficient_balance():
+    assert database.reserve_balance('6281', 6000) is None
+    assert _balance() == 5000
+
+def test_reserve_leaves_no_transaction_open():
+    database.reserve_balance('6281', 1000)
+    # Another writer can take the lock immediately afterwards
+    conn = sqlite3.connect(database.DATABASE_URL, timeout=0)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.rollback()
+    conn.close()
+
+def test_refund_retries_while_locked(monkeypatch):
+    monkeypatch.setattr(database, "REFUND_RETRY_DELAY", 0)
+    real_connect = database.get_db_connection
+    failures = iter([True, True, False])
+
+    class _Locked:
+        def execute(self, *args):
+            raise sqlite3.OperationalError("database is locked")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(database, "get_db_connection", lambda: _Locked() if next(failures) else real_connect())
+    assert database.refund_balance('6281', 500) == 5500
+    monkeypatch.setattr(database, "get_db_connection", real_connect)
+    assert _balance() == 5500
+
+def test_refund_does_not_retry_other_errors(monkeypatch):
+    class _Broken:
+        def execute(self, *args):
+            raise sqlite3.OperationalError("no such table: users")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(database, "get_db_connection", lambda: _Broken())
+    with pytest.raises(sqlite3.OperationalError):
+        database.refund_balance('6281', 500)
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from bulkhead import Bulkhead, BulkheadFull, no_shedding
+
+def _hold(bulkhead, release):
+    """Occupies one slot of the bulkhead until release is set."""
+    entered = threading.Event()
+
+    def worker():
+        with bulkhead.guard():
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    entered.wait(5)
+    return thread
+
+def test_admits_up_to_max_concurrent():
+    bulkhead = Bulkhead("test", max_concurrent=2, max_wait=0.05, retry_after=3)
+    with bulkhead.guard():
+        with bulkhead.guard():
+            assert bulkhead.snapshot()["in_flight"] == 2
+    assert bulkhead.snapshot()["in_flight"] == 0
+    assert bulkhead.snapshot()["admitted"] == 2
+
+def test_rejects_after_max_wait_when_full():
+    bulkhead = Bulkhead("test", max_concurrent=1, max_wait=0.05, retry_after=3)
+    release = threading.Event()
+    holder = _hold(bulkhead, release)
+
+    started = time.monotonic()
+    with pytest.raises(BulkheadFull) as excinfo:
+        with bulkhead.guard():
+            pass
+    assert time.monotonic() - started < 1
+    assert excinfo.value.retry_after == 3
+    assert bulkhead.snapshot()["rejected"] == 1
+
+    release.set()
+    holder.join(5)
+
+def test_no_shedding_waits_for_a_slot():
+    bulkhead = Bulkhead("test", max_concurrent=1, max_wait=0.05, retry_after=3)
+    release = threading.Event()
+    holder = _hold(bulkhead, release)
+    threading.Timer(0.3, release.set).start()
+
+    started = time.monotonic()
+    with no_shedding():
+        with bulkhead.guard():
+            waited = time.monotonic() - started
+    holder.join(5)
+    # Waited well past max_wait for the holder to finish instead of being rejected
+    assert waited >= 0.2
+    assert bulkhead.snapshot()["rejected"] == 0
+
+def test_no_shedding_is_scoped():
+    bulkhead = Bulkhead("test", max_concurrent=1, max_wait=0.05, retry_after=3)
+    release = threading.Event()
+    holder = _hold(bulkhead, release)
+
+    with no_shedding():
+        pass
+    with pytest.raises(BulkheadFull):
+        with bulkhead.guard():
+            pass
+
+    release.set()
+    holder.join(5)
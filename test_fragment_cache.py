@@ -0,0 +1,46 @@
+from fragment_cache import FragmentCache
+
+def _counting_renderer(calls, value):
+    def render():
+        calls.append(value)
+        return value
+    return render
+
+def test_renders_once_per_key():
+    cache = FragmentCache()
+    calls = []
+
+    assert cache.get_or_render(1, _counting_renderer(calls, "v1")) == "v1"
+    assert cache.get_or_render(1, _counting_renderer(calls, "other")) == "v1"
+    assert calls == ["v1"]
+
+def test_new_key_renders_again():
+    cache = FragmentCache()
+    calls = []
+
+    cache.get_or_render(1, _counting_renderer(calls, "v1"))
+    assert cache.get_or_render(2, _counting_renderer(calls, "v2")) == "v2"
+    assert calls == ["v1", "v2"]
+
+def test_evicts_least_recently_used():
+    cache = FragmentCache(max_entries=2)
+    calls = []
+
+    cache.get_or_render("a", _counting_renderer(calls, "a"))
+    cache.get_or_render("b", _counting_renderer(calls, "b"))
+    # Touch "a" so "b" becomes the oldest
+    cache.get_or_render("a", _counting_renderer(calls, "a-again"))
+    cache.get_or_render("c", _counting_renderer(calls, "c"))
+
+    cache.get_or_render("a", _counting_renderer(calls, "a-again"))
+    cache.get_or_render("b", _counting_renderer(calls, "b-again"))
+    assert calls == ["a", "b", "c", "b-again"]
+
+def test_clear_forces_rerender():
+    cache = FragmentCache()
+    calls = []
+
+    cache.get_or_render(1, _counting_renderer(calls, "v1"))
+    cache.clear()
+    cache.get_or_render(1, _counting_renderer(calls, "v1"))
+    assert calls == ["v1", "v1"]
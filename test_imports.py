@@ -16,6 +16,16 @@ try:
     from database import init_db, get_db_connection, get_all_packages
     print("Importing logging...")
     import logging
+    print("Importing app...")
+    import app
+    print("Checking heavy modules are deferred...")
+    import sys
+    for heavy in ("requests", "brotli", "Crypto.Cipher.AES"):
+        if heavy in sys.modules:
+            raise ImportError(f"{heavy} was imported eagerly; it should be deferred until first use.")
+    import log_config
+    if log_config._listener is not None:
+        raise ImportError("Logging was set up at import; it should happen in initialize_app().")
     print("All imports successful!")
 except Exception as e:
     import traceback
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+import requests
+
+import api_request
+from api_request import send_payment_request, APIError, PurchaseOutcomeUnknown
+from bulkhead import BulkheadFull
+
+ENCRYPTED = {"encrypted_body": {"xdata": "x", "xtime": "1700000000000"}, "x_signature": "sig"}
+PAYLOAD = {"items": [{"item_code": "PKG"}]}
+
+class _Raw:
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self, size, decode_content=False):
+        yield self._body
+
+class _Response:
+    def __init__(self, status_code=200, body=b'{"xdata": "y", "xtime": 1}'):
+        self.status_code = status_code
+        self.headers = {}
+        self.raw = _Raw(body)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@pytest.fixture(autouse=True)
+def _no_signing(monkeypatch):
+    monkeypatch.setattr(api_request, "encryptsign_xdata", lambda **kwargs: json.loads(json.dumps(ENCRYPTED)))
+    monkeypatch.setattr(api_request, "make_x_signature_payment", lambda *args: "sig2")
+
+def _send():
+    return send_payment_request(dict(PAYLOAD), "access", "id", "token_payment", 1700000000)
+
+def test_success_returns_decrypted_result(monkeypatch):
+    monkeypatch.setattr(requests, "post", lambda *a, **kw: _Response())
+    monkeypatch.setattr(api_request, "decrypt_xdata_raw", lambda body: {"status": "SUCCESS"})
+    assert _send() == {"status": "SUCCESS"}
+
+def test_busy_xdata_after_settlement_is_outcome_unknown(monkeypatch):
+    monkeypatch.setattr(requests, "post", lambda *a, **kw: _Response())
+
+    def busy(body):
+        raise BulkheadFull("xdata", 5)
+
+    monkeypatch.setattr(api_request, "decrypt_xdata_raw", busy)
+    with pytest.raises(PurchaseOutcomeUnknown):
+        _send()
+
+def test_read_timeout_is_outcome_unknown(monkeypatch):
+    def timeout(*a, **kw):
+        raise requests.ReadTimeout("read timed out")
+
+    monkeypatch.setattr(requests, "post", timeout)
+    with pytest.raises(PurchaseOutcomeUnknown):
+        _send()
+
+def test_server_error_is_outcome_unknown(monkeypatch):
+    monkeypatch.setattr(requests, "post", lambda *a, **kw: _Response(status_code=502))
+    with pytest.raises(PurchaseOutcomeUnknown):
+        _send()
+
+def test_connect_timeout_means_nothing_was_charged(monkeypatch):
+    def timeout(*a, **kw):
+        raise requests.ConnectTimeout("connect timed out")
+
+    monkeypatch.setattr(requests, "post", timeout)
+    with pytest.raises(APIError) as excinfo:
+        _send()
+    assert not isinstance(excinfo.value, PurchaseOutcomeUnknown)
+
+def test_client_error_means_nothing_was_charged(monkeypatch):
+    monkeypatch.setattr(requests, "post", lambda *a, **kw: _Response(status_code=400))
+    with pytest.raises(APIError) as excinfo:
+        _send()
+    assert not isinstance(excinfo.value, PurchaseOutcomeUnknown)
+
+def test_unreadable_result_is_outcome_unknown(monkeypatch):
+    monkeypatch.setattr(requests, "post", lambda *a, **kw: _Response())
+    monkeypatch.setattr(api_request, "decrypt_xdata_raw", lambda body: None)
+    with pytest.raises(PurchaseOutcomeUnknown):
+        _send()
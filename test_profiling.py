@@ -0,0 +1,74 @@
+import os
+import time
+
+import pytest
+from flask import Flask
+
+import profiling
+
+@pytest.fixture(autouse=True)
+def _profile_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "CONTROL_FILE", str(tmp_path / "control.json"))
+    monkeypatch.setattr(profiling, "CONTROL_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(profiling, "_control", None)
+    monkeypatch.setattr(profiling, "_control_mtime", None)
+    monkeypatch.setattr(profiling, "_consumed_control_id", None)
+    monkeypatch.setattr(profiling, "_sampler", None)
+    yield
+    if profiling._sampler is not None:
+        profiling._sampler.stop()
+        profiling._sampler.join(1)
+
+def _refresh():
+    with profiling._state_lock:
+        profiling._refresh_control()
+    return profiling._sampler
+
+def _arm(endpoints):
+    control = profiling.arm("sample", endpoints, seconds=60, interval=0.005)
+    # Make sure the new file is seen as changed even on coarse mtime filesystems
+    os.utime(profiling.CONTROL_FILE, (time.time(), time.time() + len(endpoints)))
+    return control
+
+def test_rearming_replaces_a_live_sampler():
+    _arm(["first"])
+    first = _refresh()
+    assert first.is_alive()
+
+    control = _arm(["second", "third"])
+    second = _refresh()
+    first.join(1)
+    assert not first.is_alive()
+    assert second is not first and second.is_alive()
+    assert second.control["id"] == control["id"]
+
+def test_disarming_stops_the_sampler():
+    _arm(["first"])
+    sampler = _refresh()
+
+    profiling.disarm()
+    assert _refresh() is None
+    sampler.join(1)
+    assert not sampler.is_alive()
+
+def test_requests_after_a_rearm_are_sampled_by_the_new_window():
+    app = Flask(__name__)
+    app.add_url_rule("/second", "second", lambda: "")
+
+    _arm(["first"])
+    first = _refresh()
+    _arm(["second"])
+    second = _refresh()
+
+    with app.test_request_context("/second"):
+        profiling.before_request()
+        time.sleep(0.05)
+        profiling.teardown_request(None)
+    second.stop()
+    second.join(1)
+
+    assert not first.stacks
+    assert second.stacks
+    assert all(stack.startswith("second;") for stack in second.stacks)
+    assert any(name.startswith("sample-second-") for name in os.listdir(profiling.PROFILE_DIR))
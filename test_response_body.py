@@ -0,0 +1,97 @@
+import gzip
+import zlib
+import tracemalloc
+
+import brotli
+import pytest
+
+from crypto_helper import read_response_body, read_error_text, ResponseTooLarge
+
+BODY = b'{"xdata": "' + b"abcdefgh" * 4096 + b'", "xtime": 1}'
+
+class _Raw:
+    def __init__(self, data, chunk_size):
+        self._data = data
+        self._chunk_size = chunk_size
+
+    def stream(self, size, decode_content=False):
+        step = min(size, self._chunk_size)
+        for i in range(0, len(self._data), step):
+            yield self._data[i:i + step]
+
+class _Response:
+    """Just enough of a streamed requests.Response for read_response_body."""
+    def __init__(self, data, encoding="", chunk_size=16 * 1024, headers=None):
+        self.raw = _Raw(data, chunk_size)
+        self.headers = dict(headers or {})
+        if encoding:
+            self.headers["Content-Encoding"] = encoding
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+ENCODINGS = {
+    "": lambda data: data,
+    "gzip": gzip.compress,
+    "deflate": zlib.compress,
+    "br": brotli.compress,
+}
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_round_trip(encoding):
+    response = _Response(ENCODINGS[encoding](BODY), encoding)
+    assert read_response_body(response) == BODY
+    assert response.closed
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_round_trip_in_tiny_chunks(encoding):
+    response = _Response(ENCODINGS[encoding](BODY), encoding, chunk_size=7)
+    assert read_response_body(response) == BODY
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_body_exactly_at_the_limit_is_accepted(encoding):
+    response = _Response(ENCODINGS[encoding](BODY), encoding)
+    assert read_response_body(response, max_bytes=len(BODY)) == BODY
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_body_over_the_limit_is_rejected(encoding):
+    response = _Response(ENCODINGS[encoding](BODY), encoding)
+    with pytest.raises(ResponseTooLarge):
+        read_response_body(response, max_bytes=len(BODY) - 1)
+    assert response.closed
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_truncate_returns_the_start_of_the_body(encoding):
+    response = _Response(ENCODINGS[encoding](BODY), encoding)
+    assert read_response_body(response, max_bytes=100, truncate=True) == BODY[:100]
+
+def test_content_length_over_the_limit_is_rejected_before_reading():
+    response = _Response(BODY, headers={"Content-Length": str(len(BODY))})
+    response.raw = None
+    with pytest.raises(ResponseTooLarge):
+        read_response_body(response, max_bytes=10)
+
+def test_error_text_is_capped():
+    response = _Response(gzip.compress(b"x" * 100000), "gzip")
+    text = read_error_text(response)
+    assert 0 < len(text) <= 1024
+    assert set(text) == {"x"}
+
+@pytest.mark.parametrize("encoding,compress", [
+    ("gzip", lambda data: gzip.compress(data, 9)),
+    ("br", lambda data: brotli.compress(data, quality=5)),
+])
+def test_decompression_bomb_stays_bounded(encoding, compress):
+    bomb = compress(b"\0" * (64 * 1024 * 1024))
+    limit = 1024 * 1024
+
+    tracemalloc.start()
+    try:
+        with pytest.raises(ResponseTooLarge):
+            read_response_body(_Response(bomb, encoding), max_bytes=limit)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # 64 MiB of output would be produced without the bound
+    assert peak < 8 * limit
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from api_request import SingleFlight, APIError
+from bulkhead import BulkheadFull
+
+def _run_concurrently(flight, key, fn, callers):
+    """Starts `callers` threads on the same key while the leader is held in fn."""
+    results = [None] * callers
+    errors = [None] * callers
+
+    def worker(i):
+        try:
+            results[i] = flight.do(key, fn)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results, errors
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"items": [1, 2, 3]}
+
+    threading.Timer(0.2, release.set).start()
+    results, errors = _run_concurrently(flight, "k", fn, 5)
+
+    assert len(calls) == 1
+    assert errors == [None] * 5
+    assert all(r == {"items": [1, 2, 3]} for r in results)
+    # Every caller gets its own object
+    assert len({id(r) for r in results}) == 5
+
+def test_followers_are_isolated_from_leader_mutations():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return {"n": 1}
+
+    leader_result = {}
+
+    def leader():
+        result = flight.do("k", fn)
+        result["n"] = 99
+        result["extra"] = True
+        leader_result.update(result)
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    started.wait(5)
+
+    follower_results = []
+    follower = threading.Thread(target=lambda: follower_results.append(flight.do("k", fn)))
+    follower.start()
+    time.sleep(0.1)
+    release.set()
+    leader_thread.join(5)
+    follower.join(5)
+
+    assert leader_result == {"n": 99, "extra": True}
+    assert follower_results == [{"n": 1}]
+
+def test_followers_get_fresh_errors():
+    flight = SingleFlight()
+    release = threading.Event()
+    leader_error = APIError("upstream down")
+
+    def fn():
+        release.wait(5)
+        raise leader_error
+
+    threading.Timer(0.2, release.set).start()
+    _, errors = _run_concurrently(flight, "k", fn, 4)
+
+    assert all(isinstance(e, APIError) and str(e) == "upstream down" for e in errors)
+    assert sum(e is leader_error for e in errors) == 1
+    assert all(e.__cause__ is leader_error for e in errors if e is not leader_error)
+
+def test_followers_keep_bulkhead_rejections():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise BulkheadFull("myxl", 7)
+
+    threading.Timer(0.2, release.set).start()
+    _, errors = _run_concurrently(flight, "k", fn, 3)
+
+    assert all(isinstance(e, BulkheadFull) and e.retry_after == 7 for e in errors)
+
+def test_sequential_calls_are_not_coalesced():
+    flight = SingleFlight()
+    counter = iter(range(10))
+
+    assert flight.do("k", lambda: next(counter)) == 0
+    assert flight.do("k", lambda: next(counter)) == 1
+
+def test_different_keys_run_independently():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: "a") == "a"
+    assert flight.do("b", lambda: "b") == "b"
+    with pytest.raises(ValueError):
+        flight.do("c", lambda: (_ for _ in ()).throw(ValueError("boom")))
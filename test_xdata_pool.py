@@ -0,0 +1,138 @@
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import xdata_pool
+from bulkhead import BulkheadFull
+from xdata_pool import XdataPool, EndpointFailure
+
+A = "http://a.example"
+B = "http://b.example"
+C = "http://c.example"
+
+@pytest.fixture(autouse=True)
+def _fast_hedging(monkeypatch):
+    # Hedge after 50 ms instead of waiting for enough samples to know the p95
+    monkeypatch.setattr(xdata_pool, "HEDGE_DEFAULT_DELAY", 0.05)
+
+def _pool(*urls, latencies=None):
+    pool = XdataPool(list(urls))
+    for endpoint in pool.endpoints:
+        latency = (latencies or {}).get(endpoint.base_url)
+        if latency is not None:
+            pool.record_success(endpoint, latency)
+    return pool
+
+def _by_host(behaviours):
+    """Builds an fn(url) whose behaviour depends on the endpoint being called."""
+    calls = []
+
+    def fn(url):
+        base = url.rsplit("/", 1)[0]
+        calls.append(base)
+        behaviour = behaviours[base]
+        if callable(behaviour):
+            return behaviour()
+        return behaviour
+    return fn, calls
+
+def _after(delay, value=None, error=None):
+    def behaviour():
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return value
+    return behaviour
+
+def test_ranked_prefers_lowest_latency_then_healthy():
+    pool = _pool(A, B, C, latencies={A: 0.3, B: 0.1, C: 0.2})
+    assert [e.base_url for e in pool.ranked()] == [B, C, A]
+
+    pool.record_failure(pool.endpoints[1])
+    assert [e.base_url for e in pool.ranked()] == [C, A, B]
+
+def test_call_fails_over_on_endpoint_failure():
+    pool = _pool(A, B, latencies={A: 0.1, B: 0.2})
+    fn, calls = _by_host({A: _after(0, error=EndpointFailure("down")), B: "ok-from-b"})
+
+    assert pool.call("decrypt", fn) == "ok-from-b"
+    assert calls == [A, B]
+    assert not pool.endpoints[0].healthy
+
+def test_call_does_not_fail_over_on_other_errors():
+    pool = _pool(A, B, latencies={A: 0.1, B: 0.2})
+    fn, calls = _by_host({A: _after(0, error=ValueError("bad request")), B: "ok-from-b"})
+
+    with pytest.raises(ValueError):
+        pool.call("decrypt", fn)
+    assert calls == [A]
+
+def test_hedge_wins_when_primary_is_slow():
+    pool = _pool(A, B, latencies={A: 0.05, B: 0.06})
+    fn, calls = _by_host({A: _after(1.0, "ok-from-a"), B: "ok-from-b"})
+
+    assert pool.hedged_call("decrypt", fn) == "ok-from-b"
+    assert calls == [A, B]
+
+def test_rejected_hedge_does_not_fail_a_primary_that_succeeds():
+    pool = _pool(A, B, latencies={A: 0.05, B: 0.06})
+    fn, _ = _by_host({A: _after(0.5, "ok-from-a"), B: _after(0, error=BulkheadFull("xdata", 5))})
+
+    assert pool.hedged_call("decrypt", fn) == "ok-from-a"
+    # A bulkhead rejection says nothing about the endpoint's health
+    assert all(e.healthy for e in pool.endpoints)
+
+def test_other_hedge_errors_wait_for_the_primary():
+    pool = _pool(A, B, latencies={A: 0.05, B: 0.06})
+    fn, _ = _by_host({A: _after(0.5, "ok-from-a"), B: _after(0, error=ValueError("bad request"))})
+
+    assert pool.hedged_call("decrypt", fn) == "ok-from-a"
+
+def test_error_is_raised_once_no_attempt_is_pending():
+    pool = _pool(A, B, latencies={A: 0.05, B: 0.06})
+    fn, _ = _by_host({
+        A: _after(0.3, error=ValueError("bad request")),
+        B: _after(0, error=BulkheadFull("xdata", 5)),
+    })
+
+    # The real error is preferred over the bulkhead rejection
+    with pytest.raises(ValueError):
+        pool.hedged_call("decrypt", fn)
+
+def test_hedged_call_fails_over_when_all_launched_attempts_fail():
+    pool = _pool(A, B, C, latencies={A: 0.05, B: 0.06, C: 0.07})
+    fn, calls = _by_host({
+        A: _after(0, error=EndpointFailure("down")),
+        B: _after(0, error=EndpointFailure("down")),
+        C: "ok-from-c",
+    })
+
+    assert pool.hedged_call("decrypt", fn) == "ok-from-c"
+    assert calls == [A, B, C]
+
+def test_time_spent_in_the_guard_is_not_counted_as_latency():
+    @contextmanager
+    def slow_guard():
+        time.sleep(0.2)
+        yield
+
+    pool = XdataPool([A], guard=slow_guard)
+    fn, _ = _by_host({A: "ok-from-a"})
+
+    assert pool.call("decrypt", fn) == "ok-from-a"
+    assert pool.endpoints[0].ewma < 0.1
+
+def test_guard_rejection_propagates_without_failing_the_endpoint():
+    @contextmanager
+    def full_guard():
+        raise BulkheadFull("xdata", 5)
+        yield
+
+    pool = XdataPool([A, B], guard=full_guard)
+    fn, calls = _by_host({A: "ok-from-a", B: "ok-from-b"})
+
+    with pytest.raises(BulkheadFull):
+        pool.call("decrypt", fn)
+    assert calls == []
+    assert all(e.healthy for e in pool.endpoints)
@@ -1,4 +1,5 @@
 from api_request import get_profile, get_balance, APIError
+from bulkhead import BulkheadFull
 from datetime import datetime
 
 def get_user_data(tokens: dict) -> dict:
@@ -38,6 +39,9 @@ def get_user_data(tokens: dict) -> dict:
     except APIError as e:
         # Re-raise the APIError to be handled by the Flask route
         raise e
+    except BulkheadFull:
+        # Upstream saturated; handled by the app as a 503
+        raise
     except Exception as e:
         # Catch any other unexpected errors
         raise APIError(f"An unexpected error occurred while fetching user data: {e}")
\ No newline at end of file
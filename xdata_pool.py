@@ -0,0 +1,231 @@
+import time
+import logging
+import threading
+import contextvars
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from bulkhead import BulkheadFull
+
+# Weight of the newest sample in the latency EWMA
+EWMA_ALPHA = 0.3
+# Assumed latency for endpoints we have no samples for yet
+DEFAULT_LATENCY = 0.5
+LATENCY_WINDOW = 200
+# Samples needed before the p95 is trusted as a hedge delay
+MIN_SAMPLES_FOR_P95 = 20
+HEDGE_DEFAULT_DELAY = 0.5
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 2.0
+# Passive health: an endpoint that fails is skipped for an exponentially growing cooldown
+BASE_COOLDOWN = 2.0
+MAX_COOLDOWN = 60.0
+# Active health: endpoints in cooldown are probed this often
+HEALTH_CHECK_INTERVAL = 10.0
+HEALTH_CHECK_TIMEOUT = 3.0
+MAX_HEDGE_THREADS = 32
+
+class EndpointFailure(Exception):
+    """An endpoint-level failure (network error, 5xx) that is safe to retry elsewhere."""
+    pass
+
+class XdataEndpoint:
+    """One xdata mirror with its latency and health statistics."""
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.ewma = None
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def score(self) -> float:
+        return self.ewma if self.ewma is not None else DEFAULT_LATENCY
+
+    def p95(self) -> float | None:
+        if len(self.samples) < MIN_SAMPLES_FOR_P95:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_delay(self) -> float:
+        p95 = self.p95()
+        delay = HEDGE_DEFAULT_DELAY if p95 is None else p95
+        return max(HEDGE_MIN_DELAY, min(HEDGE_MAX_DELAY, delay))
+
+class XdataPool:
+    """
+    Routes xdata calls to the fastest healthy endpoint, failing over on
+    endpoint errors and optionally hedging slow idempotent calls.
+
+    guard, if given, returns a context manager entered around each attempt
+    (e.g. a bulkhead slot); time spent entering it isn't counted as latency.
+    """
+    def __init__(self, base_urls: list, guard=None):
+        if not base_urls:
+            raise ValueError("At least one xdata endpoint is required.")
+        self.endpoints = [XdataEndpoint(url) for url in base_urls]
+        self._guard = guard or nullcontext
+        self._lock = threading.Lock()
+        self._executor = None
+        self._health_thread = None
+
+    def ranked(self) -> list:
+        """Healthy endpoints by EWMA latency, then the ones in cooldown by how soon they recover."""
+        with self._lock:
+            healthy = sorted((e for e in self.endpoints if e.healthy), key=lambda e: e.score())
+            down = sorted((e for e in self.endpoints if not e.healthy), key=lambda e: e.down_until)
+        return healthy + down
+
+    def record_success(self, endpoint: XdataEndpoint, latency: float):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.samples.append(latency)
+            endpoint.ewma = latency if endpoint.ewma is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * endpoint.ewma
+            endpoint.failures = 0
+            endpoint.down_until = 0.0
+
+    def record_failure(self, endpoint: XdataEndpoint):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.errors += 1
+            endpoint.failures += 1
+            cooldown = min(MAX_COOLDOWN, BASE_COOLDOWN * 2 ** (endpoint.failures - 1))
+            endpoint.down_until = time.monotonic() + cooldown
+        logging.warning("xdata endpoint %s failed; cooling down for %.0fs.", endpoint.base_url, cooldown)
+        self._ensure_health_checker()
+
+    def _attempt(self, endpoint: XdataEndpoint, path: str, fn):
+        with self._guard():
+            # The clock starts once the guard is entered so queueing isn't blamed on the endpoint
+            start = time.monotonic()
+            try:
+                result = fn(endpoint.url(path))
+            except EndpointFailure:
+                self.record_failure(endpoint)
+                raise
+            latency = time.monotonic() - start
+        self.record_success(endpoint, latency)
+        return result
+
+    def call(self, path: str, fn):
+        """
+        Calls fn(url) against endpoints in ranked order until one succeeds.
+        Only EndpointFailure triggers failover; other errors propagate as-is.
+        """
+        last_error = None
+        for endpoint in self.ranked():
+            try:
+                return self._attempt(endpoint, path, fn)
+            except EndpointFailure as e:
+                last_error = e
+        raise Exception(f"All xdata endpoints failed: {last_error}")
+
+    def hedged_call(self, path: str, fn):
+        """
+        Like call(), but if the primary endpoint hasn't answered within its
+        p95 latency, the same request is also sent to the next endpoint and
+        the first successful answer wins. Only use for idempotent requests.
+        """
+        ranked = self.ranked()
+        if len(ranked) < 2 or not ranked[1].healthy:
+            return self.call(path, fn)
+
+        executor = self._get_executor()
+        pending = {}
+        candidates = iter(ranked)
+
+        def launch():
+            endpoint = next(candidates, None)
+            if endpoint is None:
+                return False
+            # Each attempt gets its own context copy so request-scoped log fields carry over
+            ctx = contextvars.copy_context()
+            pending[executor.submit(ctx.run, self._attempt, endpoint, path, fn)] = endpoint
+            return True
+
+        launch()
+        primary = ranked[0]
+        done, _ = wait(pending, timeout=primary.hedge_delay())
+        if not done:
+            logging.debug("Hedging xdata %s after %.3fs on %s.", path, primary.hedge_delay(), primary.base_url)
+            launch()
+
+        last_error = None
+        # A non-failover error only wins once no other attempt can still succeed.
+        # A bulkhead rejection (typically of the hedge) just means "no hedge".
+        other_error = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    # The slower attempt keeps running but its result is discarded
+                    return future.result()
+                if isinstance(error, EndpointFailure):
+                    last_error = error
+                elif other_error is None or isinstance(other_error, BulkheadFull):
+                    other_error = error
+            if not pending:
+                if other_error is not None:
+                    raise other_error
+                launch()
+        raise Exception(f"All xdata endpoints failed: {last_error}")
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=MAX_HEDGE_THREADS, thread_name_prefix="xdata")
+            return self._executor
+
+    def _ensure_health_checker(self):
+        with self._lock:
+            if self._health_thread is not None:
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, name="xdata-health", daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self):
+        import requests
+
+        while True:
+            time.sleep(HEALTH_CHECK_INTERVAL)
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    continue
+                try:
+                    # Any non-5xx answer means the mirror is reachable and serving
+                    response = requests.get(endpoint.base_url, timeout=HEALTH_CHECK_TIMEOUT)
+                    ok = response.status_code < 500
+                except requests.RequestException:
+                    ok = False
+                if ok:
+                    with self._lock:
+                        endpoint.failures = 0
+                        endpoint.down_until = 0.0
+                    logging.info("xdata endpoint %s is healthy again.", endpoint.base_url)
+
+    def snapshot(self) -> list:
+        """Returns per-endpoint statistics for monitoring."""
+        with self._lock:
+            return [
+                {
+                    "url": e.base_url,
+                    "healthy": e.healthy,
+                    "ewma_latency": e.ewma,
+                    "p95_latency": e.p95(),
+                    "requests": e.requests,
+                    "errors": e.errors,
+                }
+                for e in self.endpoints
+            ]